@@ -1,17 +1,21 @@
 import glob, numpy as np, matplotlib.pyplot as plt, astropy.io.fits
 from matplotlib import animation
+from ..twod import LazyCube
 def movie(pattern, output='movie', stride=1, bitrate=1800*5, fps=30, vmin=None, vmax=None, **kwargs):
 
-    # load the filenames to include
-    filenames = glob.glob(pattern)[::stride]
+    # load the filenames to include (pattern can also be a LazyCube)
+    if isinstance(pattern, LazyCube):
+        cube = pattern
+    else:
+        cube = LazyCube(pattern, stride=stride)
+    filenames = cube.filenames
 
     #initialize the plot
     i = 0
     print('opening {0}'.format(filenames[i]))
 
     # open the fits files
-    hdu = astropy.io.fits.open(filenames[i])
-    image = np.log10(hdu[0].data)
+    image = np.log10(cube[i])
 
     scale = np.max(image.shape).astype(np.float)
     figure = plt.figure(figsize=np.array(image.shape)/scale, dpi=scale*3)
@@ -33,8 +37,7 @@ def movie(pattern, output='movie', stride=1, bitrate=1800*5, fps=30, vmin=None,
         # loop over exposures
         for i in range(len(filenames)):
             print('opening {0}'.format(filenames[i]))
-            hdu = astropy.io.fits.open(filenames[i])
-            image = np.log10(hdu[0].data)
+            image = np.log10(cube[i])
 
             imshow.set_data(image)
             figure.savefig('test.png')
@@ -4,6 +4,7 @@ import matplotlib.animation as animation
 
 from .Display import *
 from .. import utils
+from ..twod import LazyCube
 
 class Movie(Display):
     '''Display 3D dataset as a movie.'''
@@ -49,8 +50,12 @@ class Movie(Display):
 
     def fromFITSfiles(self, pattern, directory=None, stride=1, bitrate=1800*5, fps=30, **kwargs):
 
-        # load the filenames to include
-        self.filenames = glob.glob(pattern)[::stride]
+        # load the filenames to include (pattern can also be a LazyCube)
+        if isinstance(pattern, LazyCube):
+            self.cube = pattern
+        else:
+            self.cube = LazyCube(pattern, stride=stride)
+        self.filenames = self.cube.filenames
 
         # make sure the output directory exists
         if directory is not None:
@@ -59,8 +64,7 @@ class Movie(Display):
         #initialize the plot
         i = 0
         self.speak('opening {0}'.format(self.filenames[i]))
-        hdu = astropy.io.fits.open(self.filenames[i])
-        self.image = np.transpose(hdu[0].data)
+        self.image = np.transpose(self.cube[i])
         self.frame = imshow(self.image, **kwargs)
 
         # initialize the animator
@@ -71,8 +75,7 @@ class Movie(Display):
             # loop over exposures
             for i in range(len(self.filenames)):
                 self.speak('opening {0}'.format(self.filenames[i]))
-                hdu = astropy.io.fits.open(self.filenames[i])
-                self.image = np.transpose(hdu[0].data)
+                self.image = np.transpose(self.cube[i])
 
                 if directory is not None:
                     output = directory + '/{0:04.0f}.png'.format(i)
@@ -1,11 +1,11 @@
 '''Tools for dealing with 1D arrays, particularly timeseries and spectra.'''
-import matplotlib.pyplot as plt, numpy as np
-import scipy.interpolate, scipy.stats
-from astropy.modeling.models import Gaussian1D
-from astropy.modeling.fitting import LevMarLSQFitter
+import numpy as np
+import heapq, functools
+from .utils import LazyModule
 
-# ignore divide errors
-np.seterr(divide='ignore')
+# plotting and scipy are only imported when they're first needed
+plt = LazyModule('matplotlib.pyplot')
+scipy = LazyModule('scipy')
 
 def minmax(x):
 	'''Return tuple of the (finite) max and min of an array.'''
@@ -21,15 +21,110 @@ def mad(x):
 	med = np.median(x)
 	return np.median(np.abs(x - med))
 
+def _segments(x, edges, right=False):
+	'''Figure out which bin (defined by edges) each element of x falls into.
+
+		Returns the bin index of every element, with -1 for anything
+		that doesn't land in any bin. By default, bins are closed on the
+		left (like np.histogram, with the last bin closed on both sides);
+		with right=True, they are closed on the right, (edges[i], edges[i+1]].
+	'''
+	nbins = len(edges) - 1
+	if right:
+		index = np.searchsorted(edges, x, side='left') - 1
+	else:
+		index = np.searchsorted(edges, x, side='right') - 1
+		# np.histogram includes the rightmost edge in the last bin
+		index[x == edges[-1]] = nbins - 1
+	index[(index < 0) | (index >= nbins)] = -1
+	return index
+
+def _segmentmedian(values, index, nbins):
+	'''Calculate the median of values within each of nbins segments.
+
+		(index says which segment each value belongs to, -1 = nowhere)
+	'''
+	ok = index >= 0
+	values, index = values[ok], index[ok]
+
+	# sort by segment, and then by value within each segment
+	order = np.lexsort((values, index))
+	values, index = values[order], index[order]
+
+	# find where each segment starts, and how long it is
+	count = np.bincount(index, minlength=nbins)
+	start = np.searchsorted(index, np.arange(nbins), side='left')
+
+	# average the two middle values (they're identical for odd counts)
+	median = np.zeros(nbins) + np.nan
+	filled = count > 0
+	s, n = start[filled], count[filled]
+	median[filled] = (values[s + (n-1)//2] + values[s + n//2])/2.0
+	return median
+
+def binstatistics(x, y, edges, yuncertainty=None, right=False):
+	'''Calculate lots of statistics of y, in bins of x, all at once.
+
+		x, y = 1D arrays (x does not need to be sorted)
+		edges = the edges of the bins (must be sorted)
+		yuncertainty = (optional) uncertainties, for the weighted mean
+		right = should bins be closed on the right (instead of the left)?
+
+		Returns a dictionary with one array (of len(edges)-1) for each of
+			count, mean, std, median, mad, weightedmean, weightederror
+		where empty bins are filled with nan. This sorts the data once,
+		rather than looping over bins, so it's O(N log N) instead of
+		O(N*nbins).
+	'''
+
+	x, y = np.asarray(x), np.asarray(y)
+	edges = np.asarray(edges)
+	nbins = len(edges) - 1
+
+	# which bin does each point fall into?
+	index = _segments(x, edges, right=right)
+	ok = index >= 0
+
+	# the simple moments, from weighted bincounts
+	count = np.bincount(index[ok], minlength=nbins)
+	sum = np.bincount(index[ok], weights=y[ok], minlength=nbins)
+	sumofsquares = np.bincount(index[ok], weights=y[ok]**2, minlength=nbins)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		mean = sum/count
+		std = np.sqrt(sumofsquares/count - mean**2)*np.sqrt(count/np.maximum(count-1.0, 1.0))
+
+	# the robust moments, from sorting within each bin
+	median = _segmentmedian(y, index, nbins)
+	deviation = np.zeros_like(y, dtype=float)
+	deviation[ok] = np.abs(y[ok] - median[index[ok]])
+	mad = _segmentmedian(deviation, index, nbins)
+
+	statistics = dict(count=count, mean=mean, std=std, median=median, mad=mad)
+
+	# the inverse-variance weighted mean, if uncertainties were supplied
+	if yuncertainty is not None:
+		w = 1.0/np.asarray(yuncertainty)[ok]**2
+		numerator = np.bincount(index[ok], weights=y[ok]*w, minlength=nbins)
+		denominator = np.bincount(index[ok], weights=w, minlength=nbins)
+		with np.errstate(divide='ignore', invalid='ignore'):
+			statistics['weightedmean'] = numerator/denominator
+			statistics['weightederror'] = np.sqrt(1.0/denominator)
+
+	return statistics
+
 def binto(x=None, y=None, yuncertainty=None,
 			binwidth=0.01,
 			test=False,
 			robust=True,
 			sem=True,
-			verbose=False):
+			verbose=False,
+			slow=False):
 	'''Bin a timeseries to a given binwidth,
 		returning both the mean and standard deviation
-			(or median and approximate robust scatter).'''
+			(or median and approximate robust scatter).
+
+		(slow=True uses the original loop over bins for the robust
+		statistics, which is O(N*nbins); the default sorts once.)'''
 
 	if test:
 		n = 1000
@@ -41,39 +136,47 @@ def binto(x=None, y=None, yuncertainty=None,
 		plt.errorbar(bx, by, be, linewidth=0, elinewidth=2, capthick=2, markersize=10, alpha=0.5, marker='.', color='blue')
 		return
 
-	min, max = np.min(x), np.max(x)
-	bins = np.arange(min, max+binwidth, binwidth)
-	count, edges = np.histogram(x, bins=bins)
-	sum, edges = np.histogram(x, bins=bins, weights=y)
-
-	if yuncertainty is not None:
+	# (empty bins divide by zero, so don't complain about it)
+	with np.errstate(divide='ignore'):
+		min, max = np.min(x), np.max(x)
+		bins = np.arange(min, max+binwidth, binwidth)
 		count, edges = np.histogram(x, bins=bins)
-		numerator, edges = np.histogram(x, bins=bins, weights=y/yuncertainty**2)
-		denominator, edges = np.histogram(x, bins=bins, weights=1.0/yuncertainty**2)
-		mean = numerator/denominator
-		std = np.sqrt(1.0/denominator)
-		error = std
-		if False:
-			for i in range(len(bins)-1):
-				print(bins[i], mean[i], error[i], count[i])
-			a = raw_input('???')
-	else:
-		if robust:
-			n= len(sum)
-			mean, std = np.zeros(n) + np.nan, np.zeros(n) + np.nan
-			for i in range(n):
-				inbin = (x>edges[i])*(x<=edges[i+1])
-				mean[i] = np.median(y[inbin])
-				std[i] = 1.48*mad(y[inbin])
-		else:
-			if yuncertainty is None:
-				mean = sum.astype(np.float)/count
-				sumofsquares, edges = np.histogram(x, bins=bins, weights=y**2)
-				std = np.sqrt(sumofsquares.astype(np.float)/count - mean**2)*np.sqrt(count.astype(np.float)/np.maximum(count-1.0, 1.0))
-		if sem:
-			error = std/np.sqrt(count)
-		else:
+		sum, edges = np.histogram(x, bins=bins, weights=y)
+
+		if yuncertainty is not None:
+			count, edges = np.histogram(x, bins=bins)
+			numerator, edges = np.histogram(x, bins=bins, weights=y/yuncertainty**2)
+			denominator, edges = np.histogram(x, bins=bins, weights=1.0/yuncertainty**2)
+			mean = numerator/denominator
+			std = np.sqrt(1.0/denominator)
 			error = std
+			if False:
+				for i in range(len(bins)-1):
+					print(bins[i], mean[i], error[i], count[i])
+				a = raw_input('???')
+		else:
+			if robust:
+				if slow:
+					n= len(sum)
+					mean, std = np.zeros(n) + np.nan, np.zeros(n) + np.nan
+					for i in range(n):
+						inbin = (x>edges[i])*(x<=edges[i+1])
+						mean[i] = np.median(y[inbin])
+						std[i] = 1.48*mad(y[inbin])
+				else:
+					# (the loop above uses bins that are closed on the right)
+					statistics = binstatistics(x, y, edges, right=True)
+					mean = statistics['median']
+					std = 1.48*statistics['mad']
+			else:
+				if yuncertainty is None:
+					mean = sum.astype(float)/count
+					sumofsquares, edges = np.histogram(x, bins=bins, weights=y**2)
+					std = np.sqrt(sumofsquares.astype(float)/count - mean**2)*np.sqrt(count.astype(float)/np.maximum(count-1.0, 1.0))
+			if sem:
+				error = std/np.sqrt(count)
+			else:
+				error = std
 
 
 	x = 0.5*(edges[1:] + edges[:-1])
@@ -85,21 +188,356 @@ def binto(x=None, y=None, yuncertainty=None,
 	if robust:
 		print("Hmmm...the robust binning feature isn't finished yet.")
 
-def mediansmooth(x, y, xsmooth=0):
+def timebinto(n=1000000, binwidth=100.0, nslow=100000):
+	'''Compare the speed of the sort-once robust binning to the loop over bins.'''
+	import time
+
+	x = np.sort(np.random.uniform(0, n, n))
+	y = np.random.randn(n)
+
+	before = time.time()
+	fast = binto(x, y, binwidth=binwidth)
+	fasttime = time.time() - before
+	print('{0} points, sort-once binning took {1:.3f}s'.format(n, fasttime))
+
+	# the loop is too slow to run on everything, so try a subset
+	x, y = x[:nslow], y[:nslow]
+	before = time.time()
+	slow = binto(x, y, binwidth=binwidth, slow=True)
+	slowtime = time.time() - before
+	fast = binto(x, y, binwidth=binwidth)
+	print('{0} points, loop-over-bins binning took {1:.3f}s'.format(nslow, slowtime))
+	for a, b in zip(fast, slow):
+		assert(np.allclose(a, b, equal_nan=True))
+	print('  (and the two methods agree)')
+
+class SlidingMedian(object):
+	'''Keep track of the median of a window of values, as values enter and leave.
+
+		This uses two heaps (a max-heap for the lower half, a min-heap for
+		the upper half), with removed values deleted lazily when they reach
+		the top. Adding or removing a value costs O(log W) for a window of W.
+	'''
+	def __init__(self, values):
+		self.values = values
+		self.low, self.high = [], []
+		self.nlow, self.nhigh = 0, 0
+		self.side = np.zeros(len(values), dtype=np.int8)
+		self.removed = np.zeros(len(values), dtype=bool)
+
+	def _prune(self):
+		'''Drop any removed values sitting at the tops of the heaps.'''
+		while self.low and self.removed[self.low[0][1]]:
+			heapq.heappop(self.low)
+		while self.high and self.removed[self.high[0][1]]:
+			heapq.heappop(self.high)
+
+	def _rebalance(self):
+		'''Keep the lower half the same size as (or one bigger than) the upper.'''
+		self._prune()
+		if self.nlow > self.nhigh + 1:
+			value, i = heapq.heappop(self.low)
+			heapq.heappush(self.high, (-value, i))
+			self.side[i] = 1
+			self.nlow -= 1
+			self.nhigh += 1
+		elif self.nlow < self.nhigh:
+			value, i = heapq.heappop(self.high)
+			heapq.heappush(self.low, (-value, i))
+			self.side[i] = -1
+			self.nlow += 1
+			self.nhigh -= 1
+		self._prune()
+
+	def add(self, i):
+		'''Add the i-th value to the window.'''
+		value = self.values[i]
+		self._prune()
+		if (self.nlow == 0) or (value <= -self.low[0][0]):
+			heapq.heappush(self.low, (-value, i))
+			self.side[i] = -1
+			self.nlow += 1
+		else:
+			heapq.heappush(self.high, (value, i))
+			self.side[i] = 1
+			self.nhigh += 1
+		self._rebalance()
+
+	def remove(self, i):
+		'''Remove the i-th value from the window.'''
+		self.removed[i] = True
+		if self.side[i] < 0:
+			self.nlow -= 1
+		else:
+			self.nhigh -= 1
+		self._rebalance()
+
+	def median(self):
+		'''Return the median of the values currently in the window.'''
+		if (self.nlow + self.nhigh) % 2:
+			return -self.low[0][0]
+		else:
+			return (-self.low[0][0] + self.high[0][0])/2.0
+
+def _windows(x, halfwidth):
+	'''For a sorted array x, find the [start, end) indices of the elements
+		within halfwidth of each element (matching np.abs(x - x[i]) <= halfwidth
+		exactly, including any floating-point rounding at the boundaries).'''
+	n = len(x)
+	start = np.searchsorted(x, x - halfwidth, side='left')
+	end = np.searchsorted(x, x + halfwidth, side='right')
+
+	# nudge the boundaries, wherever rounding disagreed with the real test
+	def inside(j, i):
+		return np.abs(x[j] - x[i]) <= halfwidth
+	i = np.arange(n)
+	while True:
+		grow = (start > 0) & inside(np.maximum(start - 1, 0), i)
+		shrink = ~inside(np.minimum(start, n - 1), i) & (start < i)
+		if not (grow.any() or shrink.any()):
+			break
+		start = start - grow + shrink
+	while True:
+		grow = (end < n) & inside(np.minimum(end, n - 1), i)
+		shrink = ~inside(np.maximum(end - 1, 0), i) & (end > i + 1)
+		if not (grow.any() or shrink.any()):
+			break
+		end = end + grow - shrink
+	return start, end
+
+def mediansmooth(x, y, xsmooth=0, slow=False):
 	'''
 		smooth a (not necessarily evenly sampled) timeseries
 
 			x = the independent variable
 			y = the dependent variable
 			xsmooth = the *half-width* of the smoothing box
+
+		This sorts x once, and slides a window along it, updating a running
+		median as points enter and leave (O(N log W) for windows of W points).
+		If the data are evenly sampled, it uses a running median filter instead.
+		Either way, windows containing a NaN are NaN (just like np.median).
+		(slow=True uses the original loop, which is O(N^2).)
 	'''
 	assert(x.shape == y.shape)
 	ysmoothed = np.zeros_like(x)
-	for i, center in enumerate(x):
-		relevant = np.abs(x - center) <= xsmooth
-		ysmoothed[i] = np.median(y[relevant])
+
+	if slow:
+		for i, center in enumerate(x):
+			relevant = np.abs(x - center) <= xsmooth
+			ysmoothed[i] = np.median(y[relevant])
+		return ysmoothed
+
+	n = len(x)
+	if n == 0:
+		return ysmoothed
+
+	# work with the data sorted by x
+	order = np.argsort(x, kind='mergesort')
+	xsorted, ysorted = x[order], y[order]
+	start, end = _windows(xsorted, xsmooth)
+	smoothed = np.zeros(n)
+
+	# NaNs would scramble the running medians, so set them aside (and
+	# keep a cumulative count of them, to find the windows they're in)
+	isnan = np.isnan(ysorted)
+	if isnan.any():
+		ysorted = np.where(isnan, 0.0, ysorted)
+	nans = np.hstack([0, np.cumsum(isnan)])
+
+	# if the windows are a fixed number of points (aside from being
+	# truncated at the edges), then we can use a running median filter
+	i = np.arange(n)
+	half = int(np.max(np.minimum(end - i - 1, i - start)))
+	even = (n > 2*half + 1) and np.all(start == np.maximum(i - half, 0)) and np.all(end == np.minimum(i + half + 1, n))
+	if even:
+		smoothed[:] = scipy.ndimage.median_filter(ysorted.astype(float), size=2*half + 1, mode='nearest')
+		# the running filter doesn't truncate at the edges, so fix them
+		for j in list(range(half)) + list(range(n - half, n)):
+			smoothed[j] = np.median(ysorted[start[j]:end[j]])
+	else:
+		window = SlidingMedian(ysorted)
+		lo, hi = 0, 0
+		for j in range(n):
+			while hi < end[j]:
+				window.add(hi)
+				hi += 1
+			while lo < start[j]:
+				window.remove(lo)
+				lo += 1
+			smoothed[j] = window.median()
+
+	# like np.median, any window with a NaN in it has a NaN median
+	smoothed[nans[end] > nans[start]] = np.nan
+
+	ysmoothed[order] = smoothed
 	return ysmoothed
 
+def _batchgaussians(x, y, weights, amplitude, mean, stddev, iterations=100, tolerance=1e-10):
+	'''Fit many Gaussians at once, with vectorized Levenberg-Marquardt steps.
+
+		x, y, weights = (npeaks, nwindow) arrays of data (weights = 0 for padding)
+		amplitude, mean, stddev = (npeaks) arrays of initial guesses
+
+		Returns the fitted (amplitude, mean, stddev).
+	'''
+
+	p = np.vstack([amplitude, mean, stddev]).T.astype(float)
+	damping = np.zeros(len(p)) + 1e-3
+
+	def model(p):
+		a, m, s = p[:,0:1], p[:,1:2], p[:,2:3]
+		z = (x - m)/s
+		g = np.exp(-0.5*z**2)
+		return a*g, g, z
+
+	def chisq(p):
+		return np.sum(weights*(y - model(p)[0])**2, axis=1)
+
+	current = chisq(p)
+	for i in range(iterations):
+
+		# the Jacobian of the model, for each peak
+		f, g, z = model(p)
+		a, s = p[:,0:1], p[:,2:3]
+		jacobian = np.empty(x.shape + (3,))
+		jacobian[:,:,0] = g
+		jacobian[:,:,1] = f*z/s
+		jacobian[:,:,2] = f*z**2/s
+
+		# the (damped) normal equations, for each peak
+		residuals = weights*(y - f)
+		alpha = np.einsum('pki,pkj,pk->pij', jacobian, jacobian, weights)
+		beta = np.einsum('pki,pk->pi', jacobian, residuals)
+		diagonal = np.einsum('pii->pi', alpha)
+		damped = alpha + damping[:,np.newaxis,np.newaxis]*(diagonal[:,:,np.newaxis]*np.eye(3))
+		try:
+			step = np.linalg.solve(damped, beta[:,:,np.newaxis])[:,:,0]
+		except np.linalg.LinAlgError:
+			step = np.einsum('pij,pj->pi', np.linalg.pinv(damped), beta)
+
+		# accept steps that improve the fit, and adjust the damping
+		trial = p + step
+		new = chisq(trial)
+		better = np.isfinite(new) & (new <= current)
+		improvement = np.abs(current - new)
+		p[better] = trial[better]
+		current[better] = new[better]
+		damping = np.where(better, damping/10.0, damping*10.0)
+		damping = np.clip(damping, 1e-12, 1e12)
+
+		# stop once nothing is changing
+		converged = better & (improvement <= tolerance*np.maximum(current, 1e-300))
+		converged |= ~better & (damping >= 1e12)
+		if converged.all():
+			break
+
+	return p[:,0], p[:,1], np.abs(p[:,2])
+
+def fitgaussians(x, y, centers, widthguess=1, maskwidth=3, batch=True):
+	'''Fit Gaussians to a bunch of peaks in a 1D array.
+
+			x, y = two 1D arrays
+			centers = indices of the (approximate) peaks to fit
+			widthguess = about how wide will the peaks be?
+			maskwidth = fits use x's within (maskwidth)*(widthguess)
+			batch = fit all the isolated peaks at once?
+
+		Returns arrays of (amplitude, mean, stddev) for each center.
+
+		With batch=True, all the peaks whose fitting windows don't overlap
+		are stacked together and fit with vectorized Levenberg-Marquardt.
+		Peaks with overlapping windows (and everything, if batch=False)
+		are fit one by one with astropy's LevMarLSQFitter.
+	'''
+
+	centers = np.asarray(centers, dtype=int)
+	n = len(centers)
+	amplitudes, means, stddevs = np.zeros(n), np.zeros(n), np.zeros(n)
+	if n == 0:
+		return amplitudes, means, stddevs
+	halfwidth = maskwidth*widthguess
+
+	# figure out which points are relevant to each fit
+	if batch and np.all(np.diff(x) >= 0):
+		start, end = _windows(x, halfwidth)
+		start, end = start[centers], end[centers]
+
+		# windows that overlap a neighbor should be fit individually
+		order = np.argsort(centers)
+		overlapping = np.zeros(n, dtype=bool)
+		touching = start[order][1:] < end[order][:-1]
+		overlapping[order[1:]] |= touching
+		overlapping[order[:-1]] |= touching
+		isolated = ~overlapping
+	else:
+		isolated = np.zeros(n, dtype=bool)
+
+	if isolated.any():
+		# stack all the windows into padded 2D arrays
+		s, e = start[isolated], end[isolated]
+		nwindow = np.max(e - s)
+		index = s[:,np.newaxis] + np.arange(nwindow)[np.newaxis,:]
+		weights = (index < e[:,np.newaxis]).astype(float)
+		index = np.minimum(index, len(x) - 1)
+		c = centers[isolated]
+		a, m, sd = _batchgaussians(x[index], y[index], weights,
+							amplitude=y[c],
+							mean=x[c],
+							stddev=np.zeros(len(c)) + widthguess)
+		amplitudes[isolated], means[isolated], stddevs[isolated] = a, m, sd
+
+	# fit the others one by one (only importing astropy if we need it)
+	if isolated.all():
+		return amplitudes, means, stddevs
+	from astropy.modeling.models import Gaussian1D
+	from astropy.modeling.fitting import LevMarLSQFitter
+	fitter = LevMarLSQFitter()
+	for i in np.nonzero(~isolated)[0]:
+		g = centers[i]
+
+		# initialize an approximate Gaussian
+		gauss = Gaussian1D(	mean=x[g],
+							amplitude=y[g],
+							stddev=widthguess)
+
+		# which points are relevant to this fit?
+		mask = np.abs(x - x[g]) <= halfwidth
+
+		# use LM to fit the peak position and width
+		fit = fitter(gauss, x[mask], y[mask])
+		amplitudes[i], means[i], stddevs[i] = fit.amplitude.value, fit.mean.value, fit.stddev.value
+
+	return amplitudes, means, stddevs
+
+def timefitgaussians(npeaks=300, n=100000, widthguess=2.0):
+	'''Compare the batched Gaussian fitter to fitting peaks one by one.'''
+	import time
+
+	# make a fake arc lamp spectrum, with lots of isolated lines
+	x = np.arange(n).astype(float)
+	truth = np.sort(np.random.choice(np.arange(50, n-50, 50), npeaks, replace=False))
+	truth = truth + np.random.uniform(-0.5, 0.5, npeaks)
+	amplitude = np.random.uniform(100, 1000, npeaks)
+	y = np.random.normal(0, 1, n)
+	for t, a in zip(truth, amplitude):
+		nearby = slice(int(t) - 20, int(t) + 20)
+		y[nearby] += a*np.exp(-0.5*(x[nearby] - t)**2/widthguess**2)
+	centers = np.round(truth).astype(int)
+
+	# warm up both methods (and their imports), so only the fitting is timed
+	for batch in [True, False]:
+		fitgaussians(x, y, centers[:2], widthguess=widthguess, batch=batch)
+
+	results = {}
+	for batch in [True, False]:
+		before = time.time()
+		results[batch] = fitgaussians(x, y, centers, widthguess=widthguess, batch=batch)
+		elapsed = time.time() - before
+		error = results[batch][1] - truth
+		print('batch={0}: {1} peaks took {2:.3f}s, centroid rms error = {3:.5f}'.format(batch, npeaks, elapsed, np.std(error)))
+	print('the two methods differ by at most {0:.2e} in centroid'.format(np.max(np.abs(results[True][1] - results[False][1]))))
+
 def peaks(	x, y,
 			plot=False,
 			xsmooth=30,
@@ -107,7 +545,8 @@ def peaks(	x, y,
 			edgebuffer=10,
 			widthguess=1,
 			maskwidth=3,
-			returnfiltered=False):
+			returnfiltered=False,
+			batch=True):
 	'''Return the significant peaks in a 1D array.
 
 			required:
@@ -120,6 +559,7 @@ def peaks(	x, y,
 				edgebuffer	# reject peaks with this distance of an edge
 				widthguess	# about how wide will the peaks be?
 				maskwidth   # peak fits use x's within (maskwidth)*(widthguess)
+				batch		# fit all the peaks at once? (see fitgaussians)
 
 			If returnfiltered==True, then will return filtered arrays:
 				(xPeaks, yPeaks, xfiltered, yfiltered).
@@ -136,11 +576,10 @@ def peaks(	x, y,
 	# calculate the mad of the whole thing
 	mad = np.median(np.abs(filtered))
 
-	# normalize the filtered timeseries
-	filtered /=mad
-
-	# calculate the derivatives
-	derivatives = (filtered[1:] - filtered[:-1])/(x[1:] - x[:-1])
+	# normalize the filtered timeseries, and calculate the derivatives
+	with np.errstate(divide='ignore'):
+		filtered /=mad
+		derivatives = (filtered[1:] - filtered[:-1])/(x[1:] - x[:-1])
 
 	# estimate peaks as zero crossings
 	guesses = np.zeros_like(x).astype(np.bool)
@@ -199,31 +638,27 @@ def peaks(	x, y,
 	# create empty lists of peaks
 	xPeaks, yPeaks = [],[]
 
-	# create a fitter object
-	fitter = LevMarLSQFitter()
-	for g in np.nonzero(guesses)[0]:
+	# fit Gaussians to all the candidate peaks
+	candidates = np.nonzero(guesses)[0]
+	amplitudes, means, stddevs = fitgaussians(x, filtered, candidates,
+								widthguess=widthguess,
+								maskwidth=maskwidth,
+								batch=batch)
 
-		# initialize an approximate Gaussian
-		gauss = Gaussian1D(	mean=x[g],
-							amplitude=filtered[g],
-							stddev=widthguess)
-
-		# which points are relevant to this fit?
-		mask = np.abs(x - x[g]) <= maskwidth*widthguess
-
-		# use LM to fit the peak position and width
-		fit = fitter(gauss, x[mask], filtered[mask])
+	for g, amplitude, mean, stddev in zip(candidates, amplitudes, means, stddevs):
 
 		# store the peak values
-		distancemoved = np.abs((fit.mean.value - x[g])/fit.stddev.value)
+		distancemoved = np.abs((mean - x[g])/stddev)
 		if distancemoved <= 3.0:
-			xPeaks.append(fit.mean.value)
-			yPeaks.append(fit.amplitude.value)
+			xPeaks.append(mean)
+			yPeaks.append(amplitude)
 
 			if plot:
 
-				# update the Gaussian's parameters, and plot it
-				gauss.parameters = fit.parameters
+				# create a Gaussian with the fitted parameters, and plot it
+				from astropy.modeling.models import Gaussian1D
+				gauss = Gaussian1D(mean=mean, amplitude=amplitude, stddev=stddev)
+				mask = np.abs(x - x[g]) <= maskwidth*widthguess
 				xfine = np.linspace(*minmax(x[mask]), num=50)
 				fitplotter.set_data(xfine, gauss(xfine))
 
@@ -282,8 +717,86 @@ def peaks(	x, y,
 	a = raw_input('what do you think of this peakfinding?')
 	return np.array(xPeaks), np.array(yPeaks)'''
 
-def subtractContinuum(s, n=3, plot=False):
-	'''Take a 1D array, use spline to subtract off continuum.
+def splinedesign(x, knots, order=3):
+	'''Create the design matrix for a least-squares B-spline,
+		with the given interior knots (and end knots at the ends of x),
+		so that np.dot(design, coefficients) is the spline at x.'''
+
+	x = np.asarray(x, dtype=float)
+	t = np.hstack([[x[0]]*(order+1), knots, [x[-1]]*(order+1)])
+	nbasis = len(t) - order - 1
+
+	# evaluate every basis function at once
+	return scipy.interpolate.BSpline(t, np.eye(nbasis), order)(x)
+
+def fitContinuum(spectra, n=3, x=None, mask=None, iterations=5, low=2.0, high=3.0, order=3):
+	'''Fit spline continua to lots of spectra at once.
+
+			required:
+			spectra = a 1D array, or a 2D array with one spectrum per row
+
+			optional:
+			n = 3, the number of (evenly spaced) interior spline knots
+			x = the independent variable (shared by all spectra)
+			mask = which points can be used (=1 where good, =0 otherwise),
+				either shared by all spectra or one per spectrum
+			iterations = how many rounds of outlier rejection to do
+			low, high = reject points more than low (below) or high (above)
+				times the robust scatter away from the continuum, so
+				absorption lines (low) can be clipped harder than noise
+
+		The spline design matrix is built once, and then the (weighted)
+		least-squares normal equations for all the spectra are solved together.
+	'''
+
+	spectra = np.asarray(spectra, dtype=float)
+	single = spectra.ndim == 1
+	spectra = np.atleast_2d(spectra)
+	nspectra, npoints = spectra.shape
+
+	# space the knots evenly in index (like subtractContinuum always has)
+	index = np.arange(npoints)
+	if x is None:
+		x = index
+	knots = np.interp((np.arange(n)+1)*npoints/(n+1.0), index, x)
+	design = splinedesign(x, knots, order=order)
+	nbasis = design.shape[1]
+	products = (design[:,:,np.newaxis]*design[:,np.newaxis,:]).reshape(npoints, -1)
+
+	if mask is None:
+		ok = np.ones(spectra.shape, dtype=bool)
+	else:
+		ok = np.broadcast_to(np.asarray(mask).astype(bool), spectra.shape).copy()
+	ok &= np.isfinite(spectra)
+	data = np.where(ok, spectra, 0.0)
+
+	for i in range(iterations):
+		# solve the normal equations, for all spectra at once
+		weights = ok.astype(float)
+		alpha = np.dot(weights, products).reshape(nspectra, nbasis, nbasis)
+		beta = np.dot(weights*data, design)
+		try:
+			coefficients = np.linalg.solve(alpha, beta[:,:,np.newaxis])[:,:,0]
+		except np.linalg.LinAlgError:
+			coefficients = np.einsum('sij,sj->si', np.linalg.pinv(alpha), beta)
+		continuum = np.dot(coefficients, design.T)
+
+		# reject outliers (asymmetrically) from the continuum, and try again
+		if i < iterations - 1:
+			residuals = np.where(ok, spectra - continuum, np.nan)
+			with np.errstate(invalid='ignore'):
+				sigma = 1.48*np.nanmedian(np.abs(residuals), axis=1)[:,np.newaxis]
+				newok = ok & (residuals > -low*sigma) & (residuals < high*sigma)
+			if (newok == ok).all():
+				break
+			ok = newok
+
+	if single:
+		return continuum[0]
+	return continuum
+
+def subtractContinuum(s, n=3, plot=False, iterations=1, **kwargs):
+	'''Take a 1D array (or a 2D array of them), use spline to subtract off continuum.
 
 			subtractContinuum(s, n=3)
 
@@ -292,17 +805,18 @@ def subtractContinuum(s, n=3, plot=False):
 
 			optional:
 			n = 3, the number of spline points to use
+			iterations = 1, how many rounds of outlier rejection
+				(the rest of the keywords go to fitContinuum)
 	'''
 
-	x = np.arange(len(s))
-	points = (np.arange(n)+1)*len(s)/(n+1)
-	spline = scipy.interpolate.LSQUnivariateSpline(x,s,points)
+	continuum = fitContinuum(s, n=n, iterations=iterations, **kwargs)
 	if plot:
+		x = np.arange(np.shape(s)[-1])
 		plt.ion()
 		plt.figure()
-		plt.plot(x, s)
-		plt.plot(x, spline(x), linewidth=5, alpha=0.5)
-	return s - spline(x)
+		plt.plot(x, np.transpose(s))
+		plt.plot(x, np.transpose(continuum), linewidth=5, alpha=0.5)
+	return s - continuum
 
 def binsizes(x):
 	'''If x is an array of bin centers, calculate what their sizes are.
@@ -313,14 +827,21 @@ def binsizes(x):
 	binsize[-1] = binsize[-2]
 	return binsize
 
-def supersample(xin=None, yin=None, xout=None, demo=False, visualize=False, slow=True):
+def supersample(xin=None, yin=None, xout=None, demo=False, visualize=False, slow=None, method='cumulative'):
 	'''Super-sample an array onto a denser array, using nearest neighbor interpolation, handling edges of pixels properly.
 		(should be flux-preserving)
 			xin = input array of coordinates
 			yin = input array of values
 			xout = output array of coordinates where you would like values.
+			method = 'cumulative' (default), 'loop', or 'dense'
 		| xin[1:] - x[0:-1] must always be bigger than the largest spacing of the supersampled array |
-		| assumes coordinates are the center edge of bins, for both xin and xout |'''
+		| assumes coordinates are the center edge of bins, for both xin and xout |
+
+		The 'cumulative' method integrates yin across the input pixels, and
+		differences that integral at the output pixel edges, so it takes
+		O(Nin + Nout) time and memory. The 'loop' method (O(Nin*Nout) time)
+		and the 'dense' method (O(Nin*Nout) memory) are the originals,
+		kept for validation; slow=True/False still selects them.'''
 	# maybe I could make this faster using np.histogram?
 
 	if demo:
@@ -343,8 +864,33 @@ def supersample(xin=None, yin=None, xout=None, demo=False, visualize=False, slow
 	xoutleft = xout - xoutbinsize/2.0
 	xoutright = xout + xoutbinsize/2.0
 
-	if slow:
-		yout = np.zeros_like(xout).astype(np.float)
+	if slow is not None:
+		method = {True:'loop', False:'dense'}[slow]
+
+	if method == 'cumulative':
+		# the pixel edges (the first left edge, then all the right edges,
+		# which always increase, even if xin is unevenly spaced)
+		edges = np.hstack([xinleft[0], xinright])
+
+		# integrate the input across pixels (each spanning the gap between
+		# its edges, so the pixels tile without gaps or overlaps), and
+		# tally up the coverage
+		integral = np.hstack([0, np.cumsum(yin*np.diff(edges))])
+		coverage = edges - edges[0]
+
+		# difference the integral at the output edges (np.interp is linear
+		# in between input edges, and constant outside them)
+		flux = np.interp(xoutright, edges, integral) - np.interp(xoutleft, edges, integral)
+		covered = np.interp(xoutright, edges, coverage) - np.interp(xoutleft, edges, coverage)
+		yout = np.zeros(len(xout))
+		ok = covered > 0
+		yout[ok] = flux[ok]/covered[ok]
+
+		# match the other methods, which zero anything hanging off the ends
+		yout[xoutright > xinright.max()] = 0
+		yout[xoutleft < xinleft.min()] = 0
+	elif method == 'loop':
+		yout = np.zeros_like(xout).astype(float)
 		for out in range(len(xout)):
 			try:
 				inleft = (xinleft <= xoutleft[out]).nonzero()[0].max()
@@ -365,7 +911,7 @@ def supersample(xin=None, yin=None, xout=None, demo=False, visualize=False, slow
 			#print "{0:4f} to {1:4f} = {2:6f}x{3:6f} + {4:6f}x{5:6f}".format(xoutleft[out], xoutright[out], leftweight, xin[inleft], rightweight, xin[inright])
 		yout[xoutright > xinright.max()] = 0
 		yout[xoutleft < xinleft.min()] = 0
-	else:
+	elif method == 'dense':
 
 		ones = np.ones((len(xin), len(xout)))
 
@@ -386,6 +932,8 @@ def supersample(xin=None, yin=None, xout=None, demo=False, visualize=False, slow
 		leftweight = (np.minimum(matrix_xinright, matrix_xoutright) - matrix_xoutleft)/matrix_xinbinsize*mask_left
 		rightweight = (matrix_xoutright - np.maximum(matrix_xinleft,matrix_xoutleft))/matrix_xinbinsize*mask_right
 		yout = np.sum((leftweight*matrix_yin+ rightweight*matrix_yin),0)/np.sum(leftweight + rightweight,0)
+	else:
+		raise ValueError("method must be 'cumulative', 'loop', or 'dense'")
 
 
 
@@ -428,12 +976,41 @@ def supersample(xin=None, yin=None, xout=None, demo=False, visualize=False, slow
 		a = raw_input('okay?')
 	return yout
 
-def plothistogram( y, nbins=None, binwidth=0.1, ax=plt.gca(), expectation=None, scale='linear', nsigma=5, **kwargs):
+def testsupersample(n=50, factor=7.3):
+	'''Check that the cumulative supersample conserves flux, and agrees with the loop.'''
+
+	xin = np.arange(n).astype(float)
+	yin = np.random.uniform(0, 1, n) + xin
+	xout = np.linspace(xin.min(), xin.max(), int(factor*n))
+
+	fast = supersample(xin, yin, xout, method='cumulative')
+	slow = supersample(xin, yin, xout, method='loop')
+	assert(np.allclose(fast, slow))
+
+	# the flux in the output pixels should match the flux in the input pixels they cover
+	xoutbinsize = binsizes(xout)
+	inside = (xout - xoutbinsize/2.0 >= xin.min() - 0.5) & (xout + xoutbinsize/2.0 <= xin.max() + 0.5)
+	left, right = np.min((xout - xoutbinsize/2.0)[inside]), np.max((xout + xoutbinsize/2.0)[inside])
+	cdf = np.hstack([0, np.cumsum(yin)])
+	expected = np.diff(np.interp([left, right], np.hstack([xin - 0.5, xin[-1] + 0.5]), cdf))[0]
+	assert(np.allclose(np.sum((fast*xoutbinsize)[inside]), expected))
+
+	# a constant should stay constant, even on unevenly spaced (or log) grids
+	for xin in [np.cumsum(np.random.uniform(1, 3, n)), np.logspace(2, 3, n)]:
+		xout = np.linspace(xin.min(), xin.max(), int(factor*n))
+		yout = supersample(xin, np.ones(n), xout, method='cumulative')
+		xoutbinsize = binsizes(xout)
+		inside = (xout - xoutbinsize/2.0 >= xin[0] - binsizes(xin)[0]/2.0) & (xout + xoutbinsize/2.0 <= xin[-1] + binsizes(xin)[-1]/2.0)
+		assert(np.allclose(yout[inside], 1.0))
+	print('supersample conserves flux, and agrees with the slow loop')
+
+def histogramedges(y=None, nbins=None, binwidth=0.1, expectation=None, nsigma=5):
+	'''Decide on the edges of histogram bins (as plothistogram does),
+		either spanning the data, or nsigma around an expectation = (mean, width).'''
 
 	if nbins is not None:
 		binwidth = (np.max(y) - np.min(y))/nbins
 
-
 	if expectation is not None:
 		mean = expectation[0]
 		width = expectation[1]
@@ -443,29 +1020,69 @@ def plothistogram( y, nbins=None, binwidth=0.1, ax=plt.gca(), expectation=None,
 		pad = 3
 		min = np.min(y)-pad*binwidth
 		max = np.max(y)+pad*binwidth
+	return np.arange(min, max, binwidth)
+
+def expectedhistogram(edges, expectation, n=1):
+	'''How many of n draws from a Gaussian with expectation = (mean, width)
+		should land in each histogram bin? (all bins are calculated at once)'''
+	mean, width = expectation
+	return n*np.diff(scipy.special.ndtr((np.asarray(edges) - mean)/width))
+
+class Histogram(object):
+	'''
+	A histogram on fixed bins, that can be accumulated from many chunks
+	of data (without keeping the data around).
+
+	h = Histogram(edges)
+	for chunk in chunks:
+		h.add(chunk)
+	h.counts, h.expected((mean, width))
+	'''
+	def __init__(self, edges):
+		self.edges = np.asarray(edges)
+		self.counts = np.zeros(len(self.edges) - 1)
+		self.n = 0
+
+	@property
+	def centers(self):
+		return (self.edges[1:] + self.edges[0:-1])/2.0
+
+	def add(self, y):
+		'''Add a chunk of data to the histogram.'''
+		y = np.asarray(y)
+		self.counts += np.histogram(y, bins=self.edges)[0]
+		self.n += y.size
+
+	def expected(self, expectation):
+		'''The expected counts in each bin, for a Gaussian with expectation = (mean, width).'''
+		return expectedhistogram(self.edges, expectation, n=self.n)
+
+def plothistogram( y, nbins=None, binwidth=0.1, ax=None, expectation=None, scale='linear', nsigma=5, **kwargs):
 
-	yhist, edges = np.histogram(y, bins=np.arange(min, max, binwidth))
+	if ax is None:
+		ax = plt.gca()
+
+	edges = histogramedges(y, nbins=nbins, binwidth=binwidth, expectation=expectation, nsigma=nsigma)
 	if len(edges) == 1:
 		return
+	h = Histogram(edges)
+	h.add(y)
+	yhist = h.counts
 	if np.max(yhist) == 0:
 		return
 	normalization = (len(y)+0.0)/nsigma
 	yhist = np.array(yhist).astype(float)/ normalization
-	xhist = (edges[1:] + edges[0:-1])/2.0
+	xhist = h.centers
 	# if given an expectation, plot it as a histogram
 	if expectation is not None:
-		g = scipy.stats.norm(mean, width)
-		n = len(y)
-		exhist = np.zeros(len(xhist))
-		for i in range(len(xhist)):
-			start = xhist[i] - binwidth/2.0
-			finish = xhist[i] + binwidth/2.0
-			exhist[i] = n*(g.cdf(finish) - g.cdf(start))
+		exhist = h.expected(expectation)
 		bottom = np.maximum(exhist - np.sqrt(exhist), 0)/normalization
 		top = (exhist + np.sqrt(exhist))/normalization
 
 		ax.fill_betweenx(xhist, bottom, top, color='gray', alpha=0.5, linewidth=4)
 		ax.plot(top, xhist, color='gray', alpha=0.5, linewidth=4)
+	else:
+		exhist = yhist*normalization
 
 	ax.plot(np.maximum(yhist, 0.000001/normalization), xhist,  **kwargs)
 	if scale == 'log':
@@ -475,39 +1092,100 @@ def plothistogram( y, nbins=None, binwidth=0.1, ax=plt.gca(), expectation=None,
 		ax.set_xscale('linear')
 		ax.set_xlim(0, np.max(exhist/normalization)*1.3)
 
-	#ax.set_ylim(min, max)
-	#ax.set_xticks([])
-	#ax.set_yticks([])
-	#print "HISTOGRAMMING!"
-	#print xhist
-	#print yhist
-	#print exhist/normalization
-	#assert(False)
-
-def binnedrms(y):
-	'''Calculate the (unweighted) binned RMS of an array.'''
-
-	# define a dummy x variable
-	x = np.arange(len(y))
+def binnedrms(y, x=None, weights=None, sizes=None, nsizes=None):
+	'''Calculate the binned RMS of an array (or of many arrays at once).
+
+		y = a 1D array, or a 2D array with one timeseries per row
+		x = (optional) times, for irregularly sampled timeseries
+		weights = (optional) weights for a weighted mean within each bin
+		sizes = (optional) the bin sizes to use (in number of points,
+				or in units of x if x is given)
+		nsizes = (optional) use this many log-spaced bin sizes
+				(defaults to 50, if x is given)
+
+		Without x, by default every bin size from 1 up to (and including)
+		a third of the array length is used. With x, by default nsizes
+		log-spaced widths are used, from the typical spacing between
+		points up to a third of the total span. Binned means are calculated by
+		differencing cumulative sums, so all the bin sizes together take
+		O(N log N). With x, points are grouped into bins of width size,
+		starting from the first time. Either way, only complete bins are
+		included (with x, each point is treated as covering the typical
+		spacing between points, so x = np.arange(N) matches no x at all).
+
+		Returns the bin sizes, and the RMS of the binned timeseries for
+		each size (with an extra leading dimension, if y is 2D).
+	'''
 
-	# calculate for a grid of bin sizes, up to one third the y array length
-	n = np.arange(1,len(y)/3)
+	y = np.asarray(y, dtype=float)
+	N = y.shape[-1]
+
+	# decide on a grid of bin sizes
+	if x is not None:
+		# the typical spacing, and the total span covered by the points
+		x = np.asarray(x)
+		spacing = np.median(np.diff(np.sort(x)))
+		span = np.max(x) - np.min(x) + spacing
+	if sizes is None:
+		if x is not None:
+			# (there's no natural set of integer sizes, so use log-spaced widths)
+			sizes = np.logspace(np.log10(spacing), np.log10(span/3.0), nsizes or 50)
+		elif nsizes is None:
+			sizes = np.arange(1, N//3 + 1)
+		else:
+			sizes = np.unique(np.round(np.logspace(0, np.log10(N//3), nsizes)).astype(int))
+	sizes = np.asarray(sizes)
 
 	# create an array to store the RMS values for each bin size
-	rms = np.zeros(len(n))
-
-	# loop over bin sizes
-	for i in range(len(n)):
-		# use histogram to calculate a binned dataset (with binsize n[i])
-		binned = np.histogram(x, bins=np.arange(len(x)/n[i])*n[i], weights=y)[0]/n[i]
-		# calculate the RMS of that binned dataset
-		rms[i] = np.std(binned)
+	rms = np.zeros(y.shape[:-1] + (len(sizes),))
+
+	if x is None:
+		# cumulative sums, so the sum over any bin is one difference
+		if weights is None:
+			weights = np.ones(N)
+		weights = np.broadcast_to(weights, y.shape)
+		zero = np.zeros(y.shape[:-1] + (1,))
+		numerator = np.concatenate([zero, np.cumsum(weights*y, axis=-1)], axis=-1)
+		denominator = np.concatenate([zero, np.cumsum(weights, axis=-1)], axis=-1)
+
+		# loop over bin sizes (each costs only N/size)
+		for i, n in enumerate(sizes):
+			edges = np.arange(0, (N//n)*n + 1, n)
+			binned = np.diff(numerator[...,edges], axis=-1)/np.diff(denominator[...,edges], axis=-1)
+			rms[...,i] = np.std(binned, axis=-1)
+	else:
+		if weights is None:
+			weights = np.ones(N)
+		weights = np.broadcast_to(weights, y.shape).reshape(-1, N)
+		flat = y.reshape(-1, N)
+		nrows = flat.shape[0]
+		for i, width in enumerate(sizes):
+			# which bin is each point in (leaving out the incomplete one at the end)?
+			# (the 1e-9 keeps rounding from moving points that sit exactly on edges)
+			nbins = int(np.floor(span/width + 1e-9))
+			index = np.floor((x - np.min(x))/width + 1e-9).astype(int)
+			index = np.minimum(index, nbins)
+
+			# (with a different set of bins for each row, and one extra to throw away)
+			index = index[np.newaxis,:] + (nbins + 1)*np.arange(nrows)[:,np.newaxis]
+			total = np.bincount(index.flatten(), weights=(weights*flat).flatten(), minlength=(nbins + 1)*nrows)
+			count = np.bincount(index.flatten(), weights=weights.flatten(), minlength=(nbins + 1)*nrows)
+			total, count = total.reshape(nrows, nbins + 1)[:,:nbins], count.reshape(nrows, nbins + 1)[:,:nbins]
+
+			# calculate the RMS of the bins that contain data
+			filled = count > 0
+			binned = np.where(filled, total/np.where(filled, count, 1), 0.0)
+			nfilled = np.sum(filled, axis=-1)
+			mean = np.sum(binned, axis=-1)/nfilled
+			variance = np.sum(filled*(binned - mean[:,np.newaxis])**2, axis=-1)/nfilled
+			rms[...,i] = np.sqrt(variance).reshape(y.shape[:-1])
 
 	# return the array of binsizes and RMS values corresponding to those binsizes
-	return n, rms
+	return sizes, rms
 
-def plotbinnedrms(y, ax=None, xunit=1, scale='log', yunits=1, yrange=[50,5000], updateifpossible=True, **kwargs):
-	n, rms = binnedrms(y*yunits)
+def plotbinnedrms(y, ax=None, xunit=1, scale='log', yunits=1, yrange=[50,5000], updateifpossible=True, sizes=None, nsizes=None, **kwargs):
+	'''Plot the binned RMS of an array (from binnedrms), as a function of bin size.'''
+	n, rms = binnedrms(y*yunits, sizes=sizes, nsizes=nsizes)
 	x = xunit*n
 
 	# if the plot is already full,
@@ -529,15 +1207,59 @@ def plotbinnedrms(y, ax=None, xunit=1, scale='log', yunits=1, yrange=[50,5000],
 		ax.set_xlim(0, np.max(x)+1)
 		ax.set_ylim(0, np.max(yrange))
 
-def acf(y):
+def correlationlength(N):
+	'''The (fast) FFT length correlate uses for N-element arrays,
+		long enough that the 2N-1 lags don't wrap around.'''
+	return scipy.fft.next_fast_len(2*N - 1, real=True)
+
+def conjugatetransform(g):
+	'''Pre-transform the template(s) g for correlate(..., transformed=True),
+		so templates that get correlated over and over only get
+		transformed once. Returns conj(rfft(g)), zero-padded to
+		correlationlength(N), along the last axis.'''
+	g = np.asarray(g)
+	return np.conj(scipy.fft.rfft(g, correlationlength(g.shape[-1]), axis=-1))
+
+def correlate(f, g, fft=True, transformed=False):
+	'''Calculate the (unnormalized) cross-correlation of f with g,
+		the same as np.correlate(f, g, 'full'), but using FFTs.
+
+		f = an N-element array
+		g = an N-element array, or a 2D array of many of them (one per row),
+			to correlate f with lots of templates at once
+		transformed = if True, g has already been through conjugatetransform
+
+		Returns an array with 2N-1 lags (from -(N-1) to N-1) along the last axis.
+
+		The arrays are zero-padded to a fast FFT length that's long enough
+		to avoid wrapping around, so this takes O(N log N) instead of O(N^2).
+	'''
+
+	f, g = np.asarray(f), np.asarray(g)
+	N = f.shape[-1]
+	if not fft:
+		assert(transformed == False)
+		if g.ndim == 1:
+			return np.correlate(f, g, 'full')
+		return np.array([np.correlate(f, template, 'full') for template in g])
+
+	L = correlationlength(N)
+	if not transformed:
+		g = conjugatetransform(g)
+	assert(g.shape[-1] == L//2 + 1)
+	circular = scipy.fft.irfft(scipy.fft.rfft(f, L)*g, L, axis=-1)
+
+	# rearrange so that negative lags come first
+	return np.concatenate([circular[...,L-(N-1):], circular[...,:N]], axis=-1)
+
+def acf(y, fft=True):
 	'''Calculate the autocorrelation function of an array,
 		returning an array of lags and an array with the acf.'''
 
-	a = np.correlate(y,y,'full')
-	trimmed = a[len(a)/2:]
+	a = correlate(y, y, fft=fft)
+	trimmed = a[len(a)//2:]
 	lag = np.arange(len(trimmed))
-	return lag, trimmed/np.correlate(y,y)
-
+	return lag, trimmed/np.sum(np.asarray(y)**2)
 
 def plotautocorrelation(y, 	ax=None,
 							xunit=1,
@@ -563,59 +1285,257 @@ def plotautocorrelation(y, 	ax=None,
 	ax.set_xlim(-1, end)
 	ax.set_ylim(*yrange)
 
-def ccf(f, g, scale=1.0):
-	'''Calculate the normalized cross-correlation function of two identically-size arrays.
-
-		[required]:
-		f = an N-element array (for example, spectrum of target star)
-		g = an N-element array (for example, spectrum of template star)
-		scale = a scalar indicating what the indices of f and g (one unit of "lag") correspond to
-
-	'''
+def _ccf(f, g, scale=1.0, fft=True):
+	'''Calculate the lags and the normalized cross-correlation function, as arrays.
+		(g can be a 2D array of templates, one per row)'''
 
 	# how long are our arrays
+	f, g = np.asarray(f), np.asarray(g)
 	N = len(f)
 
 	# define the x-axis, if not supplied
-	assert(len(f) == len(g))
+	assert(N == g.shape[-1])
 	x = np.arange(-N+1, N, 1.0)*scale
 
 	# calculation the normalized cross-correlation function
 	sigma_f = np.sqrt(np.sum(f**2)/N)
-	sigma_g = np.sqrt(np.sum(g**2)/N)
-	C_fg = np.correlate(f, g, 'full')/N/sigma_f/sigma_g
+	sigma_g = np.sqrt(np.sum(g**2, axis=-1)/N)
+	C_fg = correlate(f, g, fft=fft)/N/sigma_f/np.reshape(sigma_g, np.shape(sigma_g) + (1,))
+	return x, C_fg
+
+def ccf(f, g, scale=1.0, fft=True):
+	'''Calculate the normalized cross-correlation function of two identically-size arrays.
+
+		[required]:
+		f = an N-element array (for example, spectrum of target star)
+		g = an N-element array (for example, spectrum of template star)
+		scale = a scalar indicating what the indices of f and g (one unit of "lag") correspond to
+
+		[optional]:
+		fft = use FFTs (O(N log N)) rather than np.correlate (O(N^2))?
+	'''
+
+	x, C_fg = _ccf(f, g, scale=scale, fft=fft)
 
 	# WILL THIS WORK?
 	return scipy.interpolate.interp1d(x,C_fg, fill_value=0.0, bounds_error=False)
 
-def todcor(f, g1, g2, scale=1.0, luminosity_ratio=None):
-	'''Calculate the 2D correlation of a 1D array with two template arrays.'''
+def ccfs(f, templates, scale=1.0):
+	'''Calculate the normalized cross-correlation functions of one array
+		with many templates at once (templates is a 2D array, one per row).
+
+		Returns the lags, and a 2D array of CCFs (one row per template).
+	'''
+	return _ccf(f, templates, scale=scale, fft=True)
+
+def _todcor(C_1, C_2, C_12, sigma_g1, sigma_g2, luminosity_ratio=None):
+	'''Combine (already evaluated) CCFs into the TODCOR correlation,
+		returning the correlation and the luminosity ratio.'''
+
+	if luminosity_ratio is None:
+		bestalphaprime = sigma_g1/sigma_g2*(C_1*C_12 - C_2)/(C_2*C_12 - C_1)
+		a = np.maximum(np.minimum(bestalphaprime, sigma_g2/sigma_g1), 0.0)
+		flexiblecorrelation = (C_1 + a*C_2)/np.sqrt(1.0 + 2*a*C_12 + a**2)
+		ok = np.isfinite(a)
+		peak = np.argmax(flexiblecorrelation[ok].flatten())
+		a = a[ok].flatten()[peak]
+	else:
+		a = luminosity_ratio*sigma_g2/sigma_g1
+	return (C_1 + a*C_2)/np.sqrt(1.0 + 2*a*C_12 + a**2), a*sigma_g1/sigma_g2
+
+def todcor(f, g1, g2, scale=1.0, luminosity_ratio=None, fft=True):
+	'''Calculate the 2D correlation of a 1D array with two template arrays.
+
+		Returns a function R(s1, s2), giving the correlation (and the
+		luminosity ratio) at lags s1 and s2 for the two templates.'''
 
 	assert(len(f) == len(g1))
 	assert(len(f) == len(g2))
 
-	C_1 = ccf(f, g1, scale=scale)
-	C_2 = ccf(f, g2, scale=scale)
-	C_12 = ccf(g1, g2, scale=scale)
+	# calculate the three CCFs once, and interpolate them as needed
+	x, c_1 = _ccf(f, g1, scale=scale, fft=fft)
+	x, c_2 = _ccf(f, g2, scale=scale, fft=fft)
+	x, c_12 = _ccf(g1, g2, scale=scale, fft=fft)
+	def C_1(s):
+		return np.interp(s, x, c_1, left=0.0, right=0.0)
+	def C_2(s):
+		return np.interp(s, x, c_2, left=0.0, right=0.0)
+	def C_12(s):
+		return np.interp(s, x, c_12, left=0.0, right=0.0)
 
 	N = len(f)
 	sigma_g1 = np.sqrt(np.sum(g1**2)/N)
 	sigma_g2 = np.sqrt(np.sum(g2**2)/N)
 
-	def bestalphaprime(s1, s2):
-		return sigma_g1/sigma_g2*(C_1(s1)*C_12(s2 - s1) - C_2(s2))/(C_2(s2)*C_12(s2-s1) - C_1(s1))
-
 	def R(s1, s2):
-		#a =
-		if luminosity_ratio is None:
-			a = np.maximum(np.minimum(bestalphaprime(s1,s2), sigma_g2/sigma_g1), 0.0)
-			flexiblecorrelation = (C_1(s1) + a*C_2(s2))/np.sqrt(1.0 + 2*a*C_12(s2 - s1) + a**2)
-			ok = np.isfinite(a)
-			peak = np.argmax(flexiblecorrelation[ok].flatten())
-			a = a[ok].flatten()[peak]
-		else:
-			a = luminosity_ratio*sigma_g2/sigma_g1
-		#print "alpha spans", np.min(a), np.max(a)
-		return (C_1(s1) + a*C_2(s2))/np.sqrt(1.0 + 2*a*C_12(s2 - s1) + a**2), a*sigma_g1/sigma_g2
+		return _todcor(C_1(s1), C_2(s2), C_12(s2 - s1), sigma_g1, sigma_g2, luminosity_ratio=luminosity_ratio)
+
+	# precompute the whole surface on a grid of lags (s1 along rows, s2 along columns)
+	def surface(lags1, lags2=None):
+		if lags2 is None:
+			lags2 = lags1
+		lags1, lags2 = np.asarray(lags1), np.asarray(lags2)
+		return _todcor(C_1(lags1)[:,np.newaxis], C_2(lags2)[np.newaxis,:],
+						C_12(lags2[np.newaxis,:] - lags1[:,np.newaxis]),
+						sigma_g1, sigma_g2, luminosity_ratio=luminosity_ratio)
+	R.surface = surface
 
 	return R
+
+def _readonly(result):
+	'''Make any arrays in a result (or inside tuples, lists, or dicts of them) read-only.'''
+	if isinstance(result, np.ndarray):
+		result.flags.writeable = False
+	elif isinstance(result, (tuple, list)):
+		for r in result:
+			_readonly(r)
+	elif isinstance(result, dict):
+		for r in result.values():
+			_readonly(r)
+	return result
+
+def _memoize(method):
+	'''Remember what a TimeSeries method returns (for each set of arguments),
+		until the TimeSeries changes. The remembered arrays are read-only,
+		so whoever asks for them can't accidentally change them for everyone.'''
+	@functools.wraps(method)
+	def memoized(self, *args, **kwargs):
+		key = (method.__name__, args, tuple(sorted(kwargs.items())))
+		try:
+			result = self._cache[key]
+		except KeyError:
+			result = _readonly(method(self, *args, **kwargs))
+			self._cache[key] = result
+		except TypeError:
+			# (unhashable arguments can't be remembered)
+			return method(self, *args, **kwargs)
+
+		# (hand out copies of containers, so they can't be rearranged either)
+		if isinstance(result, dict):
+			return dict(result)
+		if isinstance(result, list):
+			return list(result)
+		return result
+	return memoized
+
+class TimeSeries(object):
+	'''
+	A timeseries (x, y, and optionally uncertainty), that remembers
+	things calculated from it (sort order, binning, MAD, ACF, ...), so
+	they don't need to be recalculated every time they're needed.
+
+	ts = TimeSeries(x, y, uncertainty)
+	ts.binto(0.01)		# calculated the first time...
+	ts.binto(0.01)		# ...and remembered after that
+	ts.y = newy			# changing x, y, or uncertainty forgets everything
+
+	The arrays are stored read-only, so they can't be changed in place
+	without the TimeSeries knowing (assign new arrays instead).
+	'''
+
+	_arrays = ['x', 'y', 'uncertainty']
+
+	def __init__(self, x=None, y=None, uncertainty=None):
+		if x is None:
+			x = np.arange(len(y))
+		self.x, self.y, self.uncertainty = x, y, uncertainty
+
+	def __setattr__(self, name, value):
+		if name in self._arrays:
+			if value is not None:
+				value = np.array(value)
+				value.flags.writeable = False
+			object.__setattr__(self, '_cache', {})
+		object.__setattr__(self, name, value)
+
+	def __len__(self):
+		return len(self.y)
+
+	def forget(self):
+		'''Forget everything that has been calculated.'''
+		self._cache = {}
+
+	@property
+	@_memoize
+	def order(self):
+		'''The indices that would sort the timeseries by x.'''
+		return np.argsort(self.x, kind='mergesort')
+
+	@_memoize
+	def edges(self, binwidth):
+		'''The edges of bins of a given width (as used by binto).'''
+		return np.arange(np.min(self.x), np.max(self.x)+binwidth, binwidth)
+
+	@_memoize
+	def bins(self, binwidth, right=False):
+		'''Which bin (of a given width) each point falls in (-1 = none).'''
+		return _segments(self.x, self.edges(binwidth), right=right)
+
+	@_memoize
+	def binstatistics(self, binwidth, right=False):
+		'''All the statistics from binstatistics, in bins of a given width.'''
+		return binstatistics(self.x, self.y, self.edges(binwidth),
+							yuncertainty=self.uncertainty, right=right)
+
+	@_memoize
+	def binto(self, binwidth=0.01, robust=True, sem=True):
+		'''Bin to a given binwidth (see binto).'''
+		return binto(self.x, self.y, yuncertainty=self.uncertainty,
+						binwidth=binwidth, robust=robust, sem=sem)
+
+	@_memoize
+	def median(self):
+		'''The median of y.'''
+		return np.median(self.y)
+
+	@_memoize
+	def mad(self):
+		'''The median absolute deviation of y (see mad).'''
+		return np.median(np.abs(self.y - self.median()))
+
+	@_memoize
+	def acf(self):
+		'''The autocorrelation function of y (see acf).'''
+		return acf(self.y[self.order])
+
+	@_memoize
+	def binnedrms(self, sizes=None, nsizes=None):
+		'''The RMS of y, binned over a range of bin sizes in units
+			of x, so irregular sampling is handled (see binnedrms).'''
+		if sizes is not None:
+			sizes = np.asarray(sizes)
+		return binnedrms(self.y, x=self.x, sizes=sizes, nsizes=nsizes)
+
+	@_memoize
+	def mediansmooth(self, xsmooth=0):
+		'''A median-smoothed version of y (see mediansmooth).'''
+		return mediansmooth(self.x, self.y, xsmooth=xsmooth)
+
+def testtimeseries(n=1000):
+	'''Check that a TimeSeries remembers results, forgets them when it
+		changes, and gives the same answers as the functions it wraps.'''
+
+	x = np.sort(np.random.uniform(0, 10, n))
+	y = np.random.normal(0, 1, n)
+	ts = TimeSeries(x, y)
+
+	for robust in [True, False]:
+		first = ts.binto(0.5, robust=robust)
+		assert(ts.binto(0.5, robust=robust) is first)
+		expected = binto(x, y, binwidth=0.5, robust=robust)
+		for a, b in zip(first, expected):
+			assert(np.array_equal(a, b, equal_nan=True))
+
+	# what it hands out can't be changed
+	try:
+		ts.binto(0.5)[1][0] = 999
+		assert(False)
+	except ValueError:
+		pass
+
+	# changing the data forgets everything
+	assert(np.isclose(ts.mad(), mad(y)))
+	ts.y = 2*y
+	assert(np.isclose(ts.mad(), mad(2*y)))
+	assert(np.allclose(ts.binnedrms(nsizes=5)[1], binnedrms(2*y, x=x, nsizes=5)[1]))
+	print('TimeSeries remembers, forgets, and agrees with the functions it wraps')
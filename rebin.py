@@ -0,0 +1,139 @@
+'''Tools for rebinning arrays onto coarser (or finer) grids of pixels.'''
+import numpy as np
+from . import resample
+
+reducers = dict(sum=np.sum, mean=np.mean, median=np.median, max=np.max, min=np.min)
+
+def _factors(shape, newshape):
+	'''Figure out the (integer) block size along each axis, if there is one.'''
+	shape, newshape = tuple(shape), tuple(newshape)
+	assert(len(shape) == len(newshape))
+	if all([(n > 0) and (s % n == 0) for s, n in zip(shape, newshape)]):
+		return tuple([s//n for s, n in zip(shape, newshape)])
+	else:
+		return None
+
+def block(a, newshape, how='mean'):
+	'''
+	Rebin an array into a smaller array of the same rank, combining
+	blocks of pixels. The new dimensions must be factors of the original
+	dimensions (e.g. a (6,4) array can become (6,2), (3,4), (2,1), ...).
+
+		a = the array
+		newshape = the shape of the rebinned array
+		how = 'sum', 'mean', 'median', 'max', or 'min'
+
+	The blocks are created by reshaping a view of the array (nothing is
+	copied, except for the median).
+	'''
+	a = np.asarray(a)
+	factors = _factors(a.shape, newshape)
+	if factors is None:
+		raise ValueError("{0} isn't a factor of {1}".format(newshape, a.shape))
+
+	# reshape into (n0, f0, n1, f1, ...), where f's are the block sizes
+	interleaved = []
+	for n, f in zip(newshape, factors):
+		interleaved.extend([n, f])
+	blocks = a.reshape(interleaved)
+	ndim = len(factors)
+
+	if how in ['sum', 'mean']:
+		# collapse one block axis at a time
+		rebinned = blocks
+		for i in range(ndim):
+			rebinned = rebinned.sum(i+1)
+		if how == 'mean':
+			for f in factors:
+				rebinned = rebinned/f
+		return rebinned
+	elif how in reducers:
+		# gather all the block axes at the end, and combine them there
+		order = list(range(0, 2*ndim, 2)) + list(range(1, 2*ndim, 2))
+		gathered = blocks.transpose(order).reshape(tuple(newshape) + (-1,))
+		return reducers[how](gathered, axis=-1)
+	else:
+		raise ValueError("how must be one of {0}".format(list(reducers.keys())))
+
+def overlap(a, newshape, how='sum'):
+	'''
+	Rebin an array onto a new shape, by any (including non-integer) factor,
+	splitting input pixels between output pixels according to how much
+	of each one falls in each, so the total flux is conserved.
+
+		a = the array
+		newshape = the shape of the rebinned array
+		how = 'sum' (conserve the total) or 'mean' (conserve the average)
+
+	This is done one axis at a time, with the sparse (cached) overlap
+	matrices from zachopy.resample.
+	'''
+	if how not in ['sum', 'mean']:
+		raise ValueError("how must be 'sum' or 'mean' for fractional rebinning")
+
+	rebinned = np.asarray(a).astype(float)
+	for axis, (nin, nout) in enumerate(zip(rebinned.shape, newshape)):
+		if nin == nout:
+			continue
+
+		# pixel centers (in units of input pixels) for input and output
+		xin = np.arange(nin) + 0.5
+		xout = (np.arange(nout) + 0.5)*nin/float(nout)
+		weights = resample.operator(xin, xout)
+
+		# apply the weights along this axis
+		moved = np.moveaxis(rebinned, axis, 0)
+		flat = weights.dot(moved.reshape(nin, -1))
+		rebinned = np.moveaxis(flat.reshape((nout,) + moved.shape[1:]), 0, axis)
+		if how == 'mean':
+			rebinned = rebinned*nout/float(nin)
+	return rebinned
+
+def rebin(a, newshape, how='mean', memory=None):
+	'''
+	Rebin an array onto a new shape.
+
+		a = the array (which can be an np.memmap)
+		newshape = the shape of the rebinned array
+		how = 'sum', 'mean', 'median', 'max', or 'min'
+		memory = (optional) about how many bytes to load at once
+
+	If the new shape evenly divides the old one, pixels are combined in
+	blocks (see block); otherwise, they're split according to their
+	fractional overlaps (see overlap; only for 'sum' and 'mean').
+	With memory set, the array is processed in chunks along the first
+	axis, so big memory-mapped arrays are never entirely loaded.
+	'''
+	newshape = tuple(newshape)
+	if _factors(np.shape(a), newshape) is None:
+		function = overlap
+	else:
+		function = block
+
+	if memory is None:
+		return function(a, newshape, how=how)
+
+	# figure out how many input rows fit in memory at once
+	shape = np.shape(a)
+	perrow = 8*np.prod(shape)/float(shape[0])
+	if function == block:
+		# (chunks need to be a whole number of blocks)
+		factor = shape[0]//newshape[0]
+		step = int(np.maximum(memory//(perrow*factor), 1))*factor
+	else:
+		step = int(np.maximum(memory//perrow, 1))
+
+	rebinned = []
+	for start in range(0, shape[0], step):
+		chunk = np.asarray(a[start:start + step])
+		if function == block:
+			rebinned.append(block(chunk, (chunk.shape[0]//factor,) + newshape[1:], how=how))
+		else:
+			# rebin all but the first axis, one chunk of rows at a time
+			rebinned.append(overlap(chunk, chunk.shape[:1] + newshape[1:], how=how))
+	rebinned = np.concatenate(rebinned, axis=0)
+
+	if function == overlap:
+		# then, rebin along the first axis (which is now much smaller)
+		rebinned = overlap(rebinned, newshape, how=how)
+	return rebinned
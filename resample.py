@@ -1,8 +1,14 @@
 '''Tools for resampling array from grid of independent variables to another.'''
 
+import hashlib
+
 import numpy as np
-import scipy.interpolate
+import scipy.interpolate, scipy.sparse
 import matplotlib.pyplot as plt
+from .utils import LRU
+
+# the most recently used resampling operators (set operators.size to remember more)
+operators = LRU(32)
 
 def binsizes(x):
 	'''If x is an array of bin centers, calculate what their sizes are.
@@ -120,6 +126,147 @@ def fluxconservingresample(xin, yin, xout, test=False, visualize=False, demo=Fal
 	# return the resampled y-values
 	return yout
 
+def edges(x):
+	'''If x is an array of bin centers, return the len(x)+1 edges of the bins.
+		(the same edges fluxconservingresample uses for the CDF)'''
+	xbinsize = binsizes(x)
+	return np.hstack([x - xbinsize/2.0, x[-1] + xbinsize[-1]/2.0])
+
+def overlapweights(xin, xout):
+	'''
+	Calculate the sparse (len(xout) x len(xin)) matrix W, whose
+	elements are the fraction of each input pixel that falls in each
+	output pixel, so that np.dot(W, yin) = fluxconservingresample(xin, yin, xout).
+	'''
+
+	# the edges of the input and output pixels
+	ein, eout = edges(xin), edges(xout)
+	left, right = eout[:-1], eout[1:]
+	nin, nout = len(xin), len(xout)
+
+	# the range of input pixels that each output pixel touches
+	first = np.clip(np.searchsorted(ein, left, side='right') - 1, 0, nin - 1)
+	last = np.clip(np.searchsorted(ein, right, side='left') - 1, 0, nin - 1)
+	count = np.maximum(last - first + 1, 0)
+
+	# list every (output, input) pair that might overlap
+	rows = np.repeat(np.arange(nout), count)
+	offsets = np.cumsum(count) - count
+	cols = first[rows] + np.arange(np.sum(count)) - offsets[rows]
+
+	# what fraction of each input pixel lands in each output pixel?
+	overlap = np.minimum(right[rows], ein[cols + 1]) - np.maximum(left[rows], ein[cols])
+	fraction = np.maximum(overlap, 0)/(ein[cols + 1] - ein[cols])
+	ok = fraction > 0
+
+	return scipy.sparse.csr_matrix((fraction[ok], (rows[ok], cols[ok])), shape=(nout, nin))
+
+def _gridkey(x):
+	'''Create a hashable key that identifies a grid of bin centers.'''
+	x = np.ascontiguousarray(x, dtype=float)
+	return (len(x), hashlib.sha1(x.tobytes()).hexdigest())
+
+def operator(xin, xout):
+	'''
+	Return the sparse resampling operator (from overlapweights) for
+	going from xin to xout, remembering the most recent ones (up to
+	operators.size of them, least recently used are forgotten first)
+	so the same grid change never has to be calculated twice.
+	'''
+	key = (_gridkey(xin), _gridkey(xout))
+	return operators.fetch(key, lambda: overlapweights(np.asarray(xin, dtype=float), np.asarray(xout, dtype=float)))
+
+class Resampler(object):
+	'''
+	A flux-conserving resampler from one grid to another, for applying
+	the same resampling to many spectra at once. The mapping between the
+	input and output pixels is calculated once (as a sparse matrix of
+	overlap weights), and then applied with matrix products.
+
+	r = Resampler(xin, xout)
+	yout = r.resample(yin)		# yin can be 1D, or 2D with one spectrum per row
+	varout = r.variance(varin)	# propagate independent uncertainties
+	covout = r.covariance(varin)	# (the output pixels are correlated)
+	badout = r.mask(badin)		# output pixels touched by any bad input pixel
+
+	The weights are shared with operator(), so making lots of Resamplers
+	for the same grids costs nothing after the first.
+	'''
+
+	def __init__(self, xin, xout):
+		self.xin = np.asarray(xin)
+		self.xout = np.asarray(xout)
+		self.weights = operator(self.xin, self.xout)
+
+	def resample(self, yin, chunksize=None):
+		'''Resample a spectrum (or 2D array of spectra, one per row).
+
+			chunksize = (optional) how many spectra to resample at a time
+		'''
+		yin = np.asarray(yin)
+		if yin.ndim == 1:
+			return self.weights.dot(yin)
+		if chunksize is None:
+			return self.weights.dot(yin.T).T
+		yout = np.zeros((yin.shape[0], len(self.xout)))
+		for start in range(0, yin.shape[0], chunksize):
+			chunk = yin[start:start + chunksize]
+			yout[start:start + chunksize] = self.weights.dot(chunk.T).T
+		return yout
+
+	def stream(self, spectra, chunksize=100):
+		'''Resample any number of spectra (from any iterable), chunk by chunk.
+
+			This is a generator, yielding 2D arrays of up to chunksize
+			resampled spectra, so the spectra never need to all be in memory.
+		'''
+		chunk = []
+		for y in spectra:
+			chunk.append(y)
+			if len(chunk) == chunksize:
+				yield self.resample(np.vstack(chunk))
+				chunk = []
+		if len(chunk) > 0:
+			yield self.resample(np.vstack(chunk))
+
+	def transpose(self, yout):
+		'''Apply the transpose of the resampling (from the output grid back to the input).'''
+		yout = np.asarray(yout)
+		if yout.ndim == 1:
+			return self.weights.T.dot(yout)
+		return self.weights.T.dot(yout.T).T
+
+	def variance(self, varin):
+		'''Propagate (independent) input variances to the output pixels.
+
+			(these are the diagonal of the output covariance matrix)
+		'''
+		squared = self.weights.multiply(self.weights)
+		varin = np.asarray(varin)
+		if varin.ndim == 1:
+			return squared.dot(varin)
+		return squared.dot(varin.T).T
+
+	def covariance(self, covin):
+		'''Propagate input uncertainties to a covariance matrix of the output.
+
+			covin can be a 1D array of (independent) input variances,
+			or a full (dense or sparse) input covariance matrix.
+			Returns a sparse matrix, W C W^T.
+		'''
+		if np.ndim(covin) == 1:
+			covin = scipy.sparse.diags(np.asarray(covin))
+		return scipy.sparse.csr_matrix(self.weights.dot(self.weights.dot(covin).T))
+
+	def mask(self, bad):
+		'''Which output pixels contain any of the input pixels that are bad?'''
+		bad = np.asarray(bad).astype(float)
+		if bad.ndim == 1:
+			return self.weights.dot(bad) > 0
+		return self.weights.dot(bad.T).T > 0
+
+	__call__ = resample
+
 def testFCR(supersample=True):
 	'''this function tests out the resampling code
 
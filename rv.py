@@ -0,0 +1,178 @@
+'''Tools for measuring radial velocities, by cross-correlating with a bank of templates.'''
+import os, hashlib
+
+import numpy as np
+import scipy.fft
+
+from .Talker import Talker
+from . import resample, utils, oned
+
+# the speed of light, in km/s
+c = 299792.458
+
+def loglambdagrid(wavemin, wavemax, n=None, dv=None):
+	'''Create a grid of wavelengths, evenly spaced in log(wavelength),
+		with either n points or a velocity spacing of dv (km/s).'''
+	if n is None:
+		n = int(np.ceil(np.log(wavemax/wavemin)/np.log(1.0 + dv/c))) + 1
+	return np.exp(np.linspace(np.log(wavemin), np.log(wavemax), n))
+
+def _normalize(flux):
+	'''Subtract the mean and divide by the standard deviation, along the last axis.'''
+	flux = flux - np.mean(flux, axis=-1)[...,np.newaxis]
+	sigma = np.std(flux, axis=-1)[...,np.newaxis]
+	return flux/np.where(sigma > 0, sigma, 1.0)
+
+def _parabola(y, i):
+	'''Refine the location of the peak at index i, by fitting a parabola
+		through it and its two neighbors. Returns the (fractional) offset.'''
+	i = np.clip(i, 1, y.shape[-1] - 2)
+	left, middle, right = [np.take_along_axis(y, (i + k)[...,np.newaxis], axis=-1)[...,0] for k in [-1, 0, 1]]
+	curvature = left - 2*middle + right
+	with np.errstate(divide='ignore', invalid='ignore'):
+		offset = np.where(curvature < 0, 0.5*(left - right)/curvature, 0.0)
+	return i + offset
+
+class TemplateBank(Talker):
+	'''
+	A bank of template spectra, resampled onto a shared log(wavelength)
+	grid and Fourier transformed once, so that any number of observed
+	spectra can be cross-correlated against all of them in one FFT pass.
+
+	bank = TemplateBank(templatewavelengths, templatefluxes, names=names,
+						grid=loglambdagrid(500, 900, dv=1.0), cache='templates/')
+	result = bank.search(wavelength, flux)
+	print(result['name'], result['velocity'])
+
+	templatewavelengths = one wavelength array shared by all templates,
+						  or one per template
+	templatefluxes = a 2D array (or list) of template fluxes
+	grid = the log(wavelength) grid to resample everything onto
+	cache = a directory in which to save (and look for) the resampled
+			and transformed templates, so repeated runs can skip that work
+	'''
+
+	def __init__(self, templatewavelengths, templatefluxes, grid, names=None, cache=None, **kwargs):
+		Talker.__init__(self, **kwargs)
+		self.grid = np.asarray(grid)
+		self.n = len(self.grid)
+		self.names = names
+		self.dloglambda = np.log(self.grid[-1]/self.grid[0])/(self.n - 1)
+
+		# the velocity of each lag (in grid pixels)
+		self.lags = np.arange(-self.n + 1, self.n)
+		self.velocities = c*(np.exp(self.lags*self.dloglambda) - 1.0)
+
+		if np.ndim(templatewavelengths) == 1:
+			templatewavelengths = [templatewavelengths]*len(templatefluxes)
+
+		# load the transformed templates from the cache, if possible
+		filename = None
+		if cache is not None:
+			h = hashlib.sha1(self.grid.tobytes())
+			for w, f in zip(templatewavelengths, templatefluxes):
+				h.update(np.ascontiguousarray(w, dtype=float).tobytes())
+				h.update(np.ascontiguousarray(f, dtype=float).tobytes())
+			utils.mkdir(cache)
+			filename = os.path.join(cache, 'templatebank_{0}.npz'.format(h.hexdigest()))
+			if os.path.exists(filename):
+				self.speak('loading transformed templates from {0}'.format(filename))
+				with np.load(filename) as loaded:
+					self.templates, self.transforms = np.array(loaded['templates']), np.array(loaded['transforms'])
+				return
+
+		# resample all the templates onto the grid
+		self.speak('resampling {0} templates onto a grid of {1} wavelengths'.format(len(templatefluxes), self.n))
+		self.templates = np.array([self.resample(w, f) for w, f in zip(templatewavelengths, templatefluxes)])
+
+		# transform them once
+		self.transforms = oned.conjugatetransform(_normalize(self.templates))
+		if filename is not None:
+			self.speak('saving transformed templates to {0}'.format(filename))
+			np.savez(filename, templates=self.templates, transforms=self.transforms)
+
+	def resample(self, wavelength, flux):
+		'''Resample a spectrum onto the grid, as a flux density.
+
+			Where the grid pixels are bigger than the spectrum's, this
+			averages (conserving flux); where they're smaller, it
+			interpolates instead, because averaging would turn the
+			spectrum into steps at the original pixel edges, which would
+			pull the CCF peak toward whole (original) pixel shifts.'''
+
+		wavelength, flux = np.asarray(wavelength), np.asarray(flux)
+		r = resample.Resampler(wavelength, self.grid)
+		coverage = r(np.ones(len(wavelength)))
+		resampled = r(flux)
+		ok = coverage > 0
+		resampled[ok] /= coverage[ok]
+
+		# interpolate wherever the grid is finer than the spectrum
+		inputwidth = np.interp(self.grid, wavelength, resample.binsizes(wavelength))
+		fine = ok & (resample.binsizes(self.grid) < inputwidth)
+		resampled[fine] = np.interp(self.grid[fine], wavelength, flux)
+
+		# fill in anywhere the template doesn't cover with its mean
+		resampled[~ok] = np.mean(resampled[ok])
+		return resampled
+
+	def ccfs(self, wavelength, flux):
+		'''Calculate the (normalized) CCFs of a spectrum with every template.
+			Returns an array of shape (ntemplates, 2n-1), matching self.velocities.'''
+		observed = _normalize(self.resample(wavelength, flux))
+		return oned.correlate(observed, self.transforms, transformed=True)/self.n
+
+	def search(self, wavelength, flux, maxvelocity=None):
+		'''
+		Find the best template and radial velocity for a spectrum.
+
+		maxvelocity = only search velocities within +/- this (km/s)
+
+		Returns a dictionary with the best template ('index', 'name'),
+		its refined 'velocity' and 'peak' correlation, plus the 'velocities'
+		and 'ccfs' (one row per template), and each template's best
+		'velocities_per_template' and 'peaks'.
+		'''
+		ccfs = self.ccfs(wavelength, flux)
+		allowed = np.ones(len(self.velocities), dtype=bool)
+		if maxvelocity is not None:
+			allowed = np.abs(self.velocities) <= maxvelocity
+		masked = np.where(allowed, ccfs, -np.inf)
+
+		# find the peak of each CCF, refined with a parabola
+		peakindex = np.argmax(masked, axis=-1)
+		refined = _parabola(ccfs, peakindex)
+		peaks = ccfs[np.arange(len(ccfs)), peakindex]
+		lag = refined - (self.n - 1)
+		velocities = c*(np.exp(lag*self.dloglambda) - 1.0)
+
+		best = np.argmax(peaks)
+		result = dict(index=best,
+					name=None if self.names is None else self.names[best],
+					velocity=velocities[best],
+					peak=peaks[best],
+					velocities=self.velocities,
+					ccfs=ccfs,
+					velocities_per_template=velocities,
+					peaks=peaks)
+		return result
+
+def testsearch(shifts=[12.3, -47.8], dv=1.0, pixelsize=0.02, noise=0.01, nlines=60):
+	'''Inject known velocity shifts into a fake spectrum (with absorption
+		lines, sampled more coarsely than the grid), and make sure
+		TemplateBank.search recovers them to a small fraction of a grid pixel.'''
+
+	np.random.seed(42)
+	wavelength = np.arange(500.0, 600.0, pixelsize)
+	centers = np.random.uniform(505, 595, nlines)
+	depths = np.random.uniform(0.1, 0.8, nlines)
+	def spectrum(w):
+		return 1.0 - np.sum(depths[:,np.newaxis]*np.exp(-0.5*((w - centers[:,np.newaxis])/0.05)**2), 0)
+
+	bank = TemplateBank(wavelength, [spectrum(wavelength)], grid=loglambdagrid(501, 599, dv=dv))
+	for shift in shifts:
+		# the observed spectrum, Doppler shifted, on the same pixels
+		observed = spectrum(wavelength/(1.0 + shift/c)) + noise*np.random.normal(0, 1, len(wavelength))
+		velocity = bank.search(wavelength, observed, maxvelocity=200)['velocity']
+		print('injected {0:.2f} km/s, recovered {1:.2f} km/s'.format(shift, velocity))
+		assert(np.abs(velocity - shift) < 0.25*dv)
@@ -4,22 +4,93 @@
 # In[1]:
 
 
-import zachopy.color, zachopy.units as u
+import zachopy.units as u
 import matplotlib.pyplot as plt
-import numpy as np, scipy.integrate
+import numpy as np, scipy.integrate, hashlib
 import astropy.io.ascii
-get_ipython().magic(u'matplotlib inline')
+from zachopy.utils import LRU, LazyModule
+
+# (colors are only needed for plotting)
+color = LazyModule('zachopy.color')
+try:
+    get_ipython().magic(u'matplotlib inline')
+except NameError:
+    # (not in a notebook)
+    pass
 plt.style.use('dark_background')
 def gauss(x, x0, sigma):
     return 1.0/np.sqrt(2*np.pi)/sigma*np.exp(-0.5*((x-x0)/sigma)**2)
 
+# physical constants (SI)
+h = 6.626068e-34
+k = 1.3806503e-23
+c = 299792458.0
+
+# exponents bigger than this would underflow exp(-x) to zero anyway
+maxexponent = 700.0
+
+def planck(temperature, wavelength):
+    '''Planck spectrum (W/m^2/m/sr), for an array of temperatures (K)
+    and a grid of wavelengths (nm); the result has shape
+    temperature.shape + wavelength.shape. Written with exp(-x) and expm1,
+    so it neither overflows for cold temperatures (it goes to 0) nor
+    loses precision on the Rayleigh-Jeans tail.'''
+
+    temperature = np.asarray(temperature, dtype=np.float64)
+    wavelength = np.asarray(wavelength, dtype=np.float64)/1e9
+    T = temperature.reshape(temperature.shape + (1,)*wavelength.ndim)
+
+    # x = hc/lambda kT, capped so cold temperatures give exactly 0
+    with np.errstate(divide='ignore'):
+        x = np.minimum(h*c/(wavelength*k*T), maxexponent)
+    x = np.where(T > 0, x, maxexponent)
+
+    # 1/(e^x - 1) = e^-x/(1 - e^-x)
+    occupation = np.exp(-x)/-np.expm1(-x)
+    occupation[x >= maxexponent] = 0.0
+    return 2*h*c**2/wavelength**5*occupation
+
+# the most recently used normalized spectra (set _normalized.size to remember more)
+_normalized = LRU(256)
+
+def normalizedplanck(temperature, wavelength):
+    '''Planck spectra for an array of temperatures, each normalized to
+    integrate to 1 (W/m^2) over the wavelength grid (nm). Spectra too
+    cold to have any flux on the grid are all zeros. Each normalized
+    spectrum is remembered by (temperature, grid), so repeated calls
+    (like the frames of an animation) only compute the new ones.'''
+
+    temperature = np.asarray(temperature, dtype=np.float64)
+    wavelength = np.asarray(wavelength, dtype=np.float64)
+    grid = (wavelength.shape, hashlib.sha1(np.ascontiguousarray(wavelength)).hexdigest())
+
+    # pull out the ones we remember, and calculate the rest all at once
+    spectra = {}
+    for t in set(temperature.flatten()):
+        if (t, grid) in _normalized:
+            spectra[t] = _normalized[(t, grid)]
+    new = sorted(set(temperature.flatten()) - set(spectra.keys()))
+    if len(new) > 0:
+        flux = planck(new, wavelength)
+        total = np.sum(0.5*(flux[:,1:] + flux[:,:-1])*np.diff(wavelength), -1)
+        ok = total > 0
+        flux[ok] /= total[ok, np.newaxis]
+        flux[~ok] = 0.0
+        for t, f in zip(new, flux):
+            f.flags.writeable = False
+            spectra[t] = f
+            _normalized[(t, grid)] = f
+
+    return np.array([spectra[t] for t in temperature.flatten()]).reshape(
+                                temperature.shape + wavelength.shape)
+
 class Spectrum:
     def __init__(self, name):
         self.name = name
         self.wavelength = np.logspace(1, 7, 1000)
 
     def normalize(self, power=100):
-        total = scipy.integrate.trapz(self.flux, self.wavelength)
+        total = scipy.integrate.trapezoid(self.flux, self.wavelength)
         self.power = power
         self.flux = self.flux/total*power
 
@@ -34,8 +105,8 @@ class Spectrum:
         # plot the color comparison
         y = plt.gca().get_ylim()[1]
         for w in np.linspace(300, 800, 100):
-            plt.axvline(w, color=zachopy.color.nm2rgb(w))
-            #plt.scatter(w, y, color=zachopy.color.nm2rgb(w), marker='|', edgecolor='none', s=400)
+            plt.axvline(w, color=color.nm2rgb(w))
+            #plt.scatter(w, y, color=color.nm2rgb(w), marker='|', edgecolor='none', s=400)
 
 
 
@@ -64,53 +135,52 @@ class Thermal(Spectrum):
     def __init__(self, temperature=3000, power=100):
         Spectrum.__init__(self, 'The Spectrum of a {}K Thermal Source'.format(temperature))
         self.temperature = temperature
-
-        h = 6.626068e-34
-        k = 1.3806503e-23
-        c = 299792458.0
-
-        wavelength = self.wavelength/1e9
-        self.flux = 2 * h * c**2 / (wavelength**5 * (np.exp(h * c / (wavelength * k * temperature)) - 1))
-        self.normalize(power)
+        self.power = power
+        self.flux = normalizedplanck(temperature, self.wavelength)*power
 
 
 
 # In[2]:
 
 
-def contrast(albedo = 0.99):
+def contrasts(albedos):
+    '''The Sun (at 10pc), and the light reflected and emitted by an
+    Earth-size planet 1AU from it, for a whole array of albedos at once.
+    Returns the Sun (a Thermal spectrum), and the reflected and emitted
+    fluxes (with shape albedos.shape + wavelength.shape).'''
+
     distance = 10*u.pc/u.m
     semimajor = 1*u.au/u.m
     lsun = u.Lsun/u.watt
     sigma = 5.67e-8
     Teff = 5770
 
+    albedos = np.asarray(albedos, dtype=np.float64)[...,np.newaxis]
+    sun = Thermal(Teff, power=lsun/4/np.pi/distance**2)
 
-
-    sun = Thermal(5770)
-    sun.normalize(lsun/4/np.pi/distance**2)
-    sun.plot()
-
+    # (an albedo of 1 makes Teq = 0, whose spectrum is all zeros)
     flux = lsun/4/np.pi/semimajor**2
-    Teq = (flux*(1-albedo)/4/sigma)**0.25
-    #reflectedpower =
-    emitted = Thermal(Teq)
-    emitted.normalize(sun.power/4/np.pi/u.au**2*(1-albedo)*np.pi*u.Rearth**2)
-
-    reflected = Thermal(Teff)
-    reflected.normalize(sun.power/4/np.pi/u.au**2*albedo*np.pi*u.Rearth**2)
-
-    for s in [reflected, emitted]:
-        if np.isfinite(s.flux).all() == False:
-            s.flux = np.zeros_like(s.flux)
-
+    Teq = (flux*(1-albedos[...,0])/4/sigma)**0.25
+    emitted = normalizedplanck(Teq, sun.wavelength)*(sun.power/4/np.pi/u.au**2*(1-albedos)*np.pi*u.Rearth**2)
+    reflected = normalizedplanck(Teff, sun.wavelength)*(sun.power/4/np.pi/u.au**2*albedos*np.pi*u.Rearth**2)
+    return sun, reflected, emitted
+
+def contrast(albedo = 0.99, precalculated=None):
+    '''Plot the spectrum of an Earth-size planet with a given albedo.
+    (precalculated = the sun, reflected, and emitted spectra for this
+    albedo, from contrasts, so a sweep can calculate them all at once)'''
+
+    if precalculated is None:
+        precalculated = contrasts(albedo)
+    sun, reflected, emitted = precalculated
+    sun.plot()
 
     wavelength = sun.wavelength
     sunlight = sun.flux
     plt.plot(wavelength, sun.flux, color='darkgray', linewidth=5, zorder=99)
-    plt.plot(wavelength, reflected.flux, linewidth=5, linestyle='--', color='cornflowerblue', zorder=100, alpha=0.5)
-    plt.plot(wavelength, emitted.flux, linewidth=5, linestyle='--', color='lightsalmon', zorder=100, alpha=0.5)
-    plt.plot(wavelength, emitted.flux + reflected.flux, linewidth=5, color='white', zorder=99,
+    plt.plot(wavelength, reflected, linewidth=5, linestyle='--', color='cornflowerblue', zorder=100, alpha=0.5)
+    plt.plot(wavelength, emitted, linewidth=5, linestyle='--', color='lightsalmon', zorder=100, alpha=0.5)
+    plt.plot(wavelength, emitted + reflected, linewidth=5, color='white', zorder=99,
             label ='albedo = {:.2f}'.format(albedo) )
 
     plt.ylim(1e-30, 1e-10)
@@ -127,12 +197,16 @@ if __name__ == '__main__':
     wri = ani.FFMpegWriter(fps=15)
     fig = plt.figure()
 
+    # calculate the spectra for all the albedos at once
+    albedos = np.arange(0,1.001,.01)
+    sun, reflected, emitted = contrasts(albedos)
+
     with wri.saving(fig, 'planetcontrast.mp4', 200):
-        for albedo in np.arange(0,1.001,.01):
+        for i, albedo in enumerate(albedos):
             plt.cla()
-            contrast(albedo)
+            contrast(albedo, precalculated=(sun, reflected[i], emitted[i]))
             wri.grab_frame()
-            print albedo
+            print(albedo)
 
 
 # In[ ]:
@@ -1,16 +1,30 @@
 '''Tools for dealing with 2D arrays (images), or 3D arrays of images.'''
+import multiprocessing, multiprocessing.pool, hashlib, glob
 import numpy as np
-import scipy.ndimage
-import matplotlib.pyplot as plt
-try:
-    from .displays.ds9 import ds9
-except ImportError:
-    def ds9():
+from .utils import LazyModule, LRU
+
+# plotting, scipy, and astropy are only imported when they're first needed
+plt = LazyModule('matplotlib.pyplot')
+scipy = LazyModule('scipy')
+astropy = LazyModule('astropy')
+
+def ds9(*args, **kwargs):
+    '''Open a ds9 display (only importing the display tools if one is needed).'''
+    try:
+        from .displays.ds9 import ds9 as display
+    except ImportError:
         raise NameError("This is a kludge, because ds9 couldn't be imported.")
+    return display(*args, **kwargs)
+
+# the normalization images for recently used bad pixel masks (set weightcache.size to remember more)
+weightcache = LRU(8)
 
 def scatter(cube, axis=0):
     '''An outlier-robust scatter, based on the MAD, along any axis.'''
 
+    # (in case this is a LazyCube, or a filename)
+    cube = np.asarray(_opencube(cube))
+
     # figure out the shape that can be recast appropriately when subtracting a median
     shape = np.array(cube.shape)
     shape[axis] = 1
@@ -31,6 +45,8 @@ def stack(cube, axis=0, threshold=5.0):
     using a MAD noise estimator to reject outliers.
     '''
 
+    # (in case this is a LazyCube, or a filename)
+    cube = np.asarray(_opencube(cube))
 
     shape = np.array(cube.shape)
     shape[axis] = 1
@@ -42,13 +58,435 @@ def stack(cube, axis=0, threshold=5.0):
 
     return mean, noise#.squeeze()
 
-def interpolateOverBadPixels(image, bad, scale=2, visualize=False):
-    '''Take an image and a bad pixel mask (=1 where bad, =0 otherwise) and interpolate over the bad pixels, using a Gaussian smoothing.'''
-    smoothed = scipy.ndimage.filters.gaussian_filter(image*(bad == False), sigma=[scale,scale])
-    weights = scipy.ndimage.filters.gaussian_filter(np.array(bad == False).astype(np.float), sigma=[scale,scale])
+def stackclipped(cube, axis=0, threshold=5.0, iterations=5,
+                    reject='sigma', combine='mean',
+                    variances=None, nlow=1, nhigh=1, percentiles=(5, 95)):
+    '''
+    Combine a cube of images into one image, with a choice of how to
+    reject outliers, and how to combine what's left.
+
+    reject = how should outliers be identified?
+        'sigma' = clip values more than threshold*(1.48*MAD) from the
+                  median, repeating for up to iterations passes. After the
+                  first pass, only pixels where something was newly
+                  rejected get their median and MAD recalculated, so a
+                  few iterations cost not much more than one.
+        'minmax' = reject the nlow lowest and nhigh highest values
+        'percentile' = reject values outside the given percentiles
+    combine = how should the remaining values be combined?
+        'mean' = an unweighted mean
+        'weighted' = an inverse-variance weighted mean, using variances
+                     (one per frame, or a full cube of them)
+        'median' = the median
+
+    Returns (combined, noise), like stack(). With reject='sigma',
+    iterations=1, and combine='mean', this matches stack()
+    (to within rounding of the sums).
+    '''
+
+    cube = np.asarray(cube)
+    axis = axis % cube.ndim
+    shape = np.array(cube.shape)
+    shape[axis] = 1
+
+    # reshape into (frames, pixels), so we can pick out columns of pixels
+    data = np.moveaxis(cube, axis, 0).reshape(cube.shape[axis], -1)
+    nframes, npixels = data.shape
+    good = np.ones(data.shape, dtype=bool)
+
+    if reject == 'sigma':
+        center = np.zeros(npixels)
+        noise = np.zeros(npixels)
+        active = np.arange(npixels)
+        for i in range(iterations):
+            if len(active) == 0:
+                break
+
+            # recalculate the median and MAD for the columns that changed
+            if i == 0:
+                # (every column is active, so no need to copy anything out)
+                subset, goodsubset = data, good
+                c = np.median(subset, axis=0)
+                n = 1.48*np.median(np.abs(subset - c), axis=0)
+            else:
+                subset, goodsubset = data[:,active], good[:,active]
+                masked = np.where(goodsubset, subset, np.nan)
+                c = np.nanmedian(masked, axis=0)
+                n = 1.48*np.nanmedian(np.abs(masked - c), axis=0)
+            center[active], noise[active] = c, n
+
+            # reject outliers (without ever un-rejecting anything)
+            ok = (np.abs(subset - c) < threshold*n) | (n == 0)
+            newgood = goodsubset & ok
+            changed = (newgood != goodsubset).any(axis=0)
+            if i == 0:
+                good = newgood
+            else:
+                good[:,active] = newgood
+            active = active[changed]
+
+    elif reject == 'minmax':
+        ranks = np.argsort(np.argsort(data, axis=0, kind='mergesort'), axis=0, kind='mergesort')
+        good = (ranks >= nlow) & (ranks < nframes - nhigh)
+    elif reject == 'percentile':
+        low, high = np.percentile(data, percentiles, axis=0)
+        good = (data >= low) & (data <= high)
+    else:
+        raise ValueError("reject must be 'sigma', 'minmax', or 'percentile'")
+
+    # the robust scatter of whatever survived
+    if reject != 'sigma':
+        masked = np.where(good, data, np.nan)
+        noise = 1.48*np.nanmedian(np.abs(masked - np.nanmedian(masked, axis=0)), axis=0)
+
+    if combine == 'mean':
+        combined = np.sum(good*data, axis=0)/np.sum(good, axis=0)
+    elif combine == 'weighted':
+        assert(variances is not None)
+        variances = np.asarray(variances)
+        if variances.ndim == 1:
+            variances = variances.reshape(-1, 1)
+        else:
+            variances = np.moveaxis(variances, axis, 0).reshape(nframes, -1)
+        weights = good/variances
+        combined = np.sum(weights*data, axis=0)/np.sum(weights, axis=0)
+    elif combine == 'median':
+        combined = np.nanmedian(np.where(good, data, np.nan), axis=0)
+    else:
+        raise ValueError("combine must be 'mean', 'weighted', or 'median'")
+
+    imageshape = np.delete(np.array(cube.shape), axis)
+    return combined.reshape(imageshape), noise.reshape(shape)
+
+class Stacker(object):
+    '''
+    Stack images as they arrive, one at a time, without keeping them all.
+
+    s = Stacker(threshold=5.0)
+    for image in stream:
+        s.add(image)
+        mean, noise = s.stack()     # a provisional result, at any time
+
+    The results match stack(cube, axis=0) (for a cube of all the images
+    added) until more than buffersize images have arrived. After that, a
+    random sample of buffersize images is kept (reservoir sampling), and
+    its median and MAD are used to reject outliers in each new image
+    before it's added to running sums.
+    '''
+
+    def __init__(self, threshold=5.0, buffersize=50, refresh=10):
+        self.threshold = threshold
+        self.buffersize = buffersize
+        self.refresh = refresh
+        self.buffer = []
+        self.count = 0
+        self.sum, self.sumofsquares = None, None
+        self.goodsum, self.goodcount = None, None
+        self.center, self.noise = None, None
+        self.stale = 0
+
+    def __len__(self):
+        return self.count
+
+    def _estimate(self):
+        '''Update the median and robust scatter, from the buffer.'''
+        cube = np.array(self.buffer)
+        self.center = np.median(cube, axis=0)
+        self.noise = scatter(cube, axis=0)
+        self.stale = 0
+
+    def _accumulate(self, image):
+        '''Add the good pixels of one image to the running sums.'''
+        good = (np.abs(image - self.center) < self.threshold*self.noise) | (self.noise == 0)
+        self.goodsum += good*image
+        self.goodcount += good
+
+    def add(self, image):
+        '''Add one image to the stack. (The image is copied, so a reader
+            that reuses one array for every frame is safe to use.)'''
+        image = np.array(image, dtype=float)
+        self.count += 1
+        if self.sum is None:
+            self.sum = np.zeros(image.shape)
+            self.sumofsquares = np.zeros(image.shape)
+        self.sum += image
+        self.sumofsquares += image**2.0
+
+        # while the buffer is filling, just keep everything
+        if self.count <= self.buffersize:
+            self.buffer.append(image)
+            return
+
+        # once the buffer overflows, start keeping running sums of good pixels
+        if self.goodsum is None:
+            self._estimate()
+            self.goodsum = np.zeros(image.shape)
+            self.goodcount = np.zeros(image.shape)
+            for b in self.buffer:
+                self._accumulate(b)
+        elif self.stale >= self.refresh:
+            self._estimate()
+
+        self._accumulate(image)
+
+        # keep a uniformly random sample of all images in the buffer
+        replace = np.random.randint(0, self.count)
+        if replace < self.buffersize:
+            self.buffer[replace] = image
+            self.stale += 1
+
+    def stack(self):
+        '''Return the (provisional) combined image and noise, like stack().'''
+        if self.goodsum is None:
+            return stack(np.array(self.buffer), axis=0, threshold=self.threshold)
+        if self.stale > 0:
+            self._estimate()
+        shape = (1,) + self.goodsum.shape
+        return self.goodsum/self.goodcount, self.noise.reshape(shape)
+
+    def mean(self):
+        '''Return the simple (unclipped) mean and standard deviation so far.'''
+        mean = self.sum/self.count
+        return mean, np.sqrt(np.maximum(self.sumofsquares/self.count - mean**2, 0))
+
+def _tiles(shape, axis=0, itemsize=8, memory=1e9, copies=4):
+    '''
+    Split a cube into tiles (along the first axis that isn't the one being
+    combined), so that processing each one needs no more than about
+    memory bytes (assuming it needs that many full-size copies of a tile).
+
+    Returns a list of tuples of slices, for indexing into the cube.
+    '''
+
+    shape = tuple(shape)
+    axis = axis % len(shape)
+
+    # which axis should we chop up?
+    split = [i for i in range(len(shape)) if i != axis][0]
+
+    # how big is one slice along that axis?
+    perslice = itemsize*copies*np.prod(shape)/shape[split]
+    step = int(np.maximum(memory//perslice, 1))
+
+    tiles = []
+    for start in range(0, shape[split], step):
+        tile = [slice(None)]*len(shape)
+        tile[split] = slice(start, start + step)
+        tiles.append(tuple(tile))
+    return tiles
+
+class LazyCube(object):
+    '''
+    A cube of images, stored as a bunch of FITS files (one image per file),
+    that acts like a 3D array without ever loading it all into memory.
+
+    c = LazyCube('night/*.fits')
+    c.shape             # (number of files, ysize, xsize)
+    c[10]               # one image
+    c[:, 100, 200]      # the timeseries of one pixel, from all files
+    c[::2, 0:50, :]     # slicing along any axis
+
+    Each file is memory-mapped, so slices only read the pixels they need,
+    and the most recently used frames (up to cachesize) are kept open.
+    np.array(c) will load everything, if you really want it.
+    '''
+
+    def __init__(self, pattern, extension=0, stride=1, cachesize=10):
+        if isinstance(pattern, str):
+            self.filenames = sorted(glob.glob(pattern))[::stride]
+        else:
+            self.filenames = list(pattern)[::stride]
+        assert(len(self.filenames) > 0)
+        self.extension = extension
+        self._frames = LRU(cachesize)
+
+        first = self.frame(0)
+        self.shape = (len(self.filenames),) + first.shape
+        self.dtype = first.dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def frame(self, i):
+        '''Return the (memory-mapped) image from the i-th file.'''
+        return self._frames.fetch(i, lambda: astropy.io.fits.getdata(self.filenames[i], self.extension, memmap=True))
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        # expand any ... into the full slices it stands for
+        for j, k in enumerate(key):
+            if k is Ellipsis:
+                key = key[:j] + (slice(None),)*(self.ndim - len(key) + 1) + key[j+1:]
+                break
+        if len(key) == 0:
+            key = (slice(None),)
+        which, rest = key[0], key[1:]
+
+        # a single frame
+        if np.ndim(which) == 0 and not isinstance(which, slice):
+            return np.array(self.frame(range(len(self))[which])[rest])
+
+        # many frames
+        indices = np.arange(len(self))[which]
+        if len(indices) == 0:
+            return np.zeros((0,) + np.zeros(self.shape[1:])[rest].shape, dtype=self.dtype)
+        return np.array([self.frame(i)[rest] for i in indices])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __array__(self, dtype=None, copy=None):
+        cube = self[:]
+        if dtype is not None:
+            cube = cube.astype(dtype)
+        return cube
+
+def _opencube(cube):
+    '''If given a filename, open (and memory-map) the data. Filenames with
+        wildcards are opened as a LazyCube of lots of FITS files.'''
+    if isinstance(cube, str):
+        if ('*' in cube) or ('?' in cube):
+            cube = LazyCube(cube)
+        else:
+            cube = astropy.io.fits.getdata(cube, memmap=True)
+    return cube
+
+def _bytiles(function, cube, axis=0, memory=1e9, threads=1):
+    '''
+    Apply function (which combines a cube along axis, like stack or
+    scatter) to the cube tile by tile, and stitch the results together.
+
+    The function can return one array or a tuple of them; each should
+    either have axis removed, or have length 1 along axis. With threads > 1,
+    tiles are processed simultaneously by a pool of threads (numpy releases
+    the GIL for the heavy lifting, and threads share the cube's memory,
+    so nothing needs to be copied to the workers).
+    '''
+
+    cube = _opencube(cube)
+    axis = axis % cube.ndim
+    threads = threads or multiprocessing.cpu_count()
+
+    # make the tiles small enough that all the threads fit in memory at once
+    tiles = _tiles(cube.shape, axis=axis, itemsize=np.dtype(float).itemsize, memory=memory/threads)
+
+    def process(tile):
+        return function(np.asarray(cube[tile]))
+
+    if threads > 1:
+        pool = multiprocessing.pool.ThreadPool(threads)
+        try:
+            results = pool.map(process, tiles)
+        finally:
+            pool.close()
+    else:
+        results = map(process, tiles)
+
+    # stitch the tiles back together
+    outputs = None
+    for tile, result in zip(tiles, results):
+        single = not isinstance(result, tuple)
+        if single:
+            result = (result,)
+        if outputs is None:
+            outputs = []
+            for r in result:
+                shape = np.array(cube.shape)
+                shape[axis] = 1
+                if r.ndim < cube.ndim:
+                    shape = np.delete(shape, axis)
+                outputs.append(np.zeros(shape, dtype=r.dtype))
+        for o, r in zip(outputs, result):
+            if r.ndim < cube.ndim:
+                o[tile[:axis] + tile[axis+1:]] = r
+            else:
+                o[tile] = r
+
+    if single:
+        return outputs[0]
+    return tuple(outputs)
+
+def stackchunked(cube, axis=0, threshold=5.0, memory=1e9, threads=1):
+    '''
+    Combine a cube of images into one mean image, exactly like stack(),
+    but working through the cube in spatial tiles so that no more than
+    (about) memory bytes are needed at once.
+
+    cube can be an ndarray, an np.memmap, or the filename of a FITS file
+    (which will be memory-mapped), so the whole cube is never loaded.
+
+    threads = how many tiles to process in parallel (None = all the cores)
+    '''
+
+    def function(tile):
+        return stack(tile, axis=axis, threshold=threshold)
+
+    return _bytiles(function, cube, axis=axis, memory=memory, threads=threads)
+
+def scatterchunked(cube, axis=0, memory=1e9, threads=1):
+    '''
+    Calculate the same robust scatter as scatter(), but tile by tile,
+    with (optionally) several tiles processed in parallel.
+    (see stackchunked for the options)
+    '''
+
+    def function(tile):
+        return scatter(tile, axis=axis)
+
+    return _bytiles(function, cube, axis=axis, memory=memory, threads=threads)
+
+def timestacking(nframes=30, xsize=500, ysize=250, threads=None, memory=1e8):
+    '''
+    Compare how long it takes to stack a fake cube with different numbers
+    of threads (by default, everything from 1 to the number of cores).
+    '''
+    import time
+    from .displays.Display import createTestImage
+
+    cube = np.array([createTestImage(xsize=xsize, ysize=ysize) for i in range(nframes)])
+    if threads is None:
+        threads = range(1, multiprocessing.cpu_count() + 1)
+
+    reference = stack(cube)
+    for n in threads:
+        before = time.time()
+        mean, noise = stackchunked(cube, threads=n, memory=memory)
+        elapsed = time.time() - before
+        assert((mean == reference[0]).all())
+        print('stacking a {0} cube with {1} threads took {2:.3f}s'.format(cube.shape, n, elapsed))
+
+def _badpixelweights(bad, scale=2):
+    '''
+    Calculate the normalization image for interpolating over bad pixels
+    (a smoothed version of the good pixel mask), remembering the most
+    recent ones so that frames sharing the same mask never recalculate it.
+    '''
+    bad = np.asarray(bad).astype(bool)
+    key = (bad.shape, hashlib.sha1(np.ascontiguousarray(bad).tobytes()).hexdigest(), scale)
+    return weightcache.fetch(key, lambda: scipy.ndimage.gaussian_filter(np.array(bad == False).astype(float), sigma=[scale,scale]))
+
+def interpolateOverBadPixels(image, bad, scale=2, visualize=False, chunksize=100, threads=1, out=None):
+    '''Take an image and a bad pixel mask (=1 where bad, =0 otherwise) and interpolate over the bad pixels, using a Gaussian smoothing.
+
+    image can also be a cube of images (frames along the first axis) that
+    all share the same 2D bad pixel mask. Then, chunks of chunksize frames
+    are smoothed together (with threads of them in parallel), and the
+    results are written into out (a new array, if None; it could also be
+    an np.memmap, as could the cube itself).'''
+    if np.ndim(image) == 3:
+        return _interpolateCubeOverBadPixels(image, bad, scale=scale, chunksize=chunksize, threads=threads, out=out)
+    smoothed = scipy.ndimage.gaussian_filter(image*(bad == False), sigma=[scale,scale])
+    weights = _badpixelweights(bad, scale=scale)
     smoothed /=weights
     corrected = image + 0.0
-    corrected[bad.astype(np.bool)] = smoothed[bad.astype(np.bool)]
+    corrected[bad.astype(bool)] = smoothed[bad.astype(bool)]
     if visualize:
         gs = plt.matplotlib.gridspec.GridSpec(1,4, wspace=0,hspace=0)
         orig = plt.subplot(gs[0])
@@ -64,9 +502,51 @@ def interpolateOverBadPixels(image, bad, scale=2, visualize=False):
         a = raw_input('test?')
     return corrected
 
+def _interpolateCubeOverBadPixels(cube, bad, scale=2, chunksize=100, threads=1, out=None):
+    '''Interpolate over the same bad pixels in every frame of a cube.
+        (see interpolateOverBadPixels)'''
+
+    bad = np.asarray(bad).astype(bool)
+    good = bad == False
+    weights = _badpixelweights(bad, scale=scale)
+    if out is None:
+        out = np.zeros(cube.shape, dtype=(cube[:1] + 0.0).dtype)
+
+    def process(start):
+        chunk = np.asarray(cube[start:start + chunksize])
+
+        # smooth all the frames at once (but only along the spatial axes)
+        smoothed = scipy.ndimage.gaussian_filter(chunk*good, sigma=[0,scale,scale])
+        corrected = chunk + 0.0
+        corrected[:,bad] = smoothed[:,bad]/weights[bad]
+        out[start:start + chunksize] = corrected
+
+    starts = range(0, cube.shape[0], chunksize)
+    if threads > 1:
+        pool = multiprocessing.pool.ThreadPool(threads)
+        try:
+            pool.map(process, starts)
+        finally:
+            pool.close()
+    else:
+        for start in starts:
+            process(start)
+    return out
+
+
+def polyInterpolate(image, bad, axis=0, order=2, visualize=False, slow=False, iterations=1, clip=4.0):
+    '''Take an image and a bad pixel mask (=1 where bad, =0 otherwise), fit polynomials to the good data in one dimension, and return this polynomial smoothed version.
+
+    By default, all the rows (or columns) are fit at once, by solving the
+    least-squares normal equations for every row together. Before fitting,
+    points more than clip*1.48*MAD from each row's median are ignored; with
+    iterations > 1, points that far from each row's fit are also rejected,
+    and the fits are repeated. (slow=True, or visualize=True, loops over
+    the rows one by one, as this originally did.)'''
+
+    if not (slow or visualize):
+        return _polyInterpolateAll(image, bad, axis=axis, order=order, iterations=iterations, clip=clip)
 
-def polyInterpolate(image, bad, axis=0, order=2, visualize=True):
-    '''Take an image and a bad pixel mask (=1 where bad, =0 otherwise), fit polynomials to the good data in one dimension, and return this polynomial smoothed version.'''
     n = image.shape[axis]
     smoothed = np.zeros_like(image)
     if visualize:
@@ -82,7 +562,7 @@ def polyInterpolate(image, bad, axis=0, order=2, visualize=True):
         ok = baddata == 0
         med = np.median(ydata[ok])
         mad = np.median(np.abs(ydata[ok] - med))
-        ok = ok*(np.abs(ydata - med) < 4*1.48*mad)
+        ok = ok*(np.abs(ydata - med) < clip*1.48*mad)
 
 
         fit = np.polynomial.polynomial.polyfit(xdata[ok], ydata[ok], order)
@@ -125,15 +605,189 @@ def polyInterpolate(image, bad, axis=0, order=2, visualize=True):
         a = raw_input('test?')
     return corrected'''
 
-def estimateBackground(image, axis=-1):
+def _polyInterpolateAll(image, bad, axis=0, order=2, iterations=1, clip=4.0):
+    '''Fit polynomials to all the rows (axis=0) or columns (axis=1) of an image at once.
+        (see polyInterpolate)'''
 
-    display = ds9('background subtraction')
-    display.one(image, clobber=True)
+    # arrange the data so that each row is one line to fit
+    image, bad = np.asarray(image), np.asarray(bad)
+    if axis == 0:
+        ydata, ok = image.astype(float), bad == 0
+    else:
+        ydata, ok = image.T.astype(float), bad.T == 0
+    nlines, npoints = ydata.shape
 
-    roughSky1d = np.median(image, axis)
-    shape = np.array(image.shape)
-    shape[axis] = 1
-    roughSkyImage = np.ones_like(image)*roughSky1d.reshape(shape)
-    display.one(roughSkyImage)
-    display.one(image - roughSkyImage)
-    assert(False)
+    # reject outliers from each line's median
+    masked = np.where(ok, ydata, np.nan)
+    med = np.nanmedian(masked, axis=1)[:,np.newaxis]
+    mad = np.nanmedian(np.abs(masked - med), axis=1)[:,np.newaxis]
+    ok = ok*(np.abs(ydata - med) < clip*1.48*mad)
+
+    # one Vandermonde matrix (in a scaled coordinate, for better conditioning)
+    xdata = np.arange(npoints)
+    halfspan = np.maximum((npoints - 1)/2.0, 1.0)
+    vandermonde = np.polynomial.polynomial.polyvander((xdata - halfspan)/halfspan, order)
+    products = (vandermonde[:,:,np.newaxis]*vandermonde[:,np.newaxis,:]).reshape(npoints, -1)
+
+    for i in range(iterations):
+
+        # solve the normal equations for all the lines at once
+        weights = ok.astype(float)
+        alpha = np.dot(weights, products).reshape(nlines, order + 1, order + 1)
+        beta = np.dot(weights*ydata, vandermonde)
+        try:
+            coefficients = np.linalg.solve(alpha, beta[:,:,np.newaxis])[:,:,0]
+        except np.linalg.LinAlgError:
+            coefficients = np.einsum('lij,lj->li', np.linalg.pinv(alpha), beta)
+        smoothed = np.dot(coefficients, vandermonde.T)
+
+        # reject outliers from the fits, and try again
+        if i < iterations - 1:
+            residuals = np.where(ok, ydata - smoothed, np.nan)
+            mad = np.nanmedian(np.abs(residuals), axis=1)[:,np.newaxis]
+            newok = ok*(np.abs(ydata - smoothed) < clip*1.48*mad)
+            if (newok == ok).all():
+                break
+            ok = newok
+
+    if axis == 0:
+        return smoothed
+    else:
+        return smoothed.T
+
+def _clippedmedian(boxes, threshold=3.0, iterations=3):
+    '''Calculate the sigma-clipped median along the last axis (ignoring nans).'''
+    boxes = boxes + 0.0
+    for i in range(iterations):
+        center = np.nanmedian(boxes, axis=-1)[...,np.newaxis]
+        noise = 1.48*np.nanmedian(np.abs(boxes - center), axis=-1)[...,np.newaxis]
+        outliers = np.abs(boxes - center) > threshold*noise
+        if not outliers.any():
+            break
+        boxes[outliers] = np.nan
+    return np.nanmedian(boxes, axis=-1)
+
+def backgroundMesh(image, boxsize=64, threshold=3.0, iterations=3, bad=None, memory=1e9):
+    '''
+    Divide an image into boxes, and calculate a sigma-clipped median in each.
+
+    image = a 2D image
+    boxsize = the size of the boxes (one number, or (ysize, xsize))
+    threshold, iterations = how to sigma-clip within each box
+    bad = (optional) a bad pixel mask (=1 where bad, =0 otherwise)
+    memory = about how many bytes to use at once
+
+    Returns the mesh of box values, and the y and x centers of the boxes.
+    (Boxes that hang off the edges of the image are just smaller.)
+    '''
+
+    ysize, xsize = np.broadcast_to(boxsize, 2)
+    ny, nx = image.shape
+    nby, nbx = int(np.ceil(ny/float(ysize))), int(np.ceil(nx/float(xsize)))
+
+    # pad the image (with nans) out to a whole number of boxes
+    padded = np.zeros((nby*ysize, nbx*xsize)) + np.nan
+    padded[:ny,:nx] = image
+    if bad is not None:
+        padded[:ny,:nx][np.asarray(bad).astype(bool)] = np.nan
+
+    # work through the image in bands of boxes, to limit memory use
+    perrow = 8*4*ysize*padded.shape[1]
+    step = int(np.maximum(memory//perrow, 1))
+    mesh = np.zeros((nby, nbx))
+    for start in range(0, nby, step):
+        band = padded[start*ysize:(start + step)*ysize]
+        nrows = band.shape[0]//ysize
+
+        # rearrange into (box row, box column, pixels in box), without looping
+        boxes = band.reshape(nrows, ysize, nbx, xsize).swapaxes(1, 2).reshape(nrows, nbx, -1)
+        mesh[start:start + nrows] = _clippedmedian(boxes, threshold=threshold, iterations=iterations)
+
+    # fill any empty boxes
+    empty = np.isfinite(mesh) == False
+    if empty.all():
+        mesh[:] = 0.0
+    else:
+        mesh[empty] = np.median(mesh[~empty])
+
+    ycenters = np.minimum((np.arange(nby) + 0.5)*ysize, (ny + np.arange(nby)*ysize)/2.0) - 0.5
+    xcenters = np.minimum((np.arange(nbx) + 0.5)*xsize, (nx + np.arange(nbx)*xsize)/2.0) - 0.5
+    return mesh, ycenters, xcenters
+
+def interpolateMesh(mesh, ycenters, xcenters, shape, order=3):
+    '''Interpolate a mesh of values (at box centers) onto every pixel of an image, with a spline.'''
+
+    # a single box in any direction should be constant along that direction
+    if len(ycenters) == 1:
+        mesh, ycenters = np.vstack([mesh, mesh]), np.hstack([ycenters, ycenters + 1])
+    if len(xcenters) == 1:
+        mesh, xcenters = np.hstack([mesh, mesh]), np.hstack([xcenters, xcenters + 1])
+
+    ky, kx = min(order, len(ycenters) - 1), min(order, len(xcenters) - 1)
+    y, x = np.arange(shape[0]), np.arange(shape[1])
+    bbox = [min(y[0], ycenters[0]), max(y[-1], ycenters[-1]),
+            min(x[0], xcenters[0]), max(x[-1], xcenters[-1])]
+
+    # (RectBivariateSpline calls its first axis "x", which is our y)
+    spline = scipy.interpolate.RectBivariateSpline(ycenters, xcenters, mesh, bbox=bbox, kx=ky, ky=kx)
+    return spline(y, x)
+
+def estimateBackground(image, axis=-1, method='mesh', boxsize=64,
+                        threshold=3.0, iterations=3, filtersize=1, order=3,
+                        bad=None, memory=1e9, visualize=False):
+    '''
+    Estimate the (smoothly varying) background of an image.
+
+    method = 'mesh' to calculate sigma-clipped medians in boxes, and
+             interpolate between them with a spline (see backgroundMesh
+             for boxsize, threshold, iterations, bad, and memory),
+             or 'axis' for the median along axis, at every position
+             along the other one (e.g. sky along a slit)
+    filtersize = median filter the mesh over this many boxes, to
+                 suppress any boxes that are contaminated by bright stars
+    order = the order of the spline interpolating between boxes
+    visualize = show the image, background, and subtracted image in ds9?
+
+    Returns a background image, the same size as the input image.
+    '''
+
+    image = np.asarray(image)
+    if method == 'axis':
+        data = image + 0.0
+        if bad is not None:
+            data[np.asarray(bad).astype(bool)] = np.nan
+        roughSky1d = np.nanmedian(data, axis)
+        shape = np.array(image.shape)
+        shape[axis] = 1
+        background = np.ones_like(image, dtype=float)*roughSky1d.reshape(shape)
+    elif method == 'mesh':
+        mesh, ycenters, xcenters = backgroundMesh(image, boxsize=boxsize,
+                                    threshold=threshold, iterations=iterations,
+                                    bad=bad, memory=memory)
+        if filtersize > 1:
+            mesh = scipy.ndimage.median_filter(mesh, size=filtersize, mode='nearest')
+        background = interpolateMesh(mesh, ycenters, xcenters, image.shape, order=order)
+    else:
+        raise ValueError("method must be 'mesh' or 'axis'")
+
+    if visualize:
+        display = ds9('background subtraction')
+        display.one(image, clobber=True)
+        display.one(background)
+        display.one(image - background)
+
+    return background
+
+def testbackground(shapes=[(500, 400), (150, 2048), (2048, 150), (300, 257)], boxsizes=[64, 64, 64, (100, 64)]):
+    '''Make sure estimateBackground recovers a smooth background
+        underneath noise and stars, for square and very non-square meshes.'''
+    for shape, boxsize in zip(shapes, boxsizes):
+        y, x = np.mgrid[0:shape[0], 0:shape[1]]
+        truth = 100.0 + 10.0*x/shape[1] + 5.0*(y/float(shape[0]))**2
+        image = truth + np.random.normal(0, 1, shape)
+        stars = (np.random.randint(0, shape[0], 50), np.random.randint(0, shape[1], 50))
+        image[stars] += 1000.0
+        background = estimateBackground(image, boxsize=boxsize)
+        error = np.max(np.abs(background - truth))
+        print('{0} image, boxsize={1}: background within {2:.3f} of the truth'.format(shape, boxsize, error))
+        assert(error < 1.0)
@@ -1,9 +1,111 @@
 '''Utilities often used by Zach B-T. These are mostly weird, small things.'''
-import os
+import os, importlib, subprocess, sys, types
+from collections import OrderedDict
 
 import numpy as np
 
 
+class LazyModule(object):
+	'''
+	A stand-in for a module that won't actually be imported until
+	one of its attributes is first used, so that (for example)
+
+		plt = LazyModule('matplotlib.pyplot')
+
+	costs nothing at import time, but plt.plot(...) still works later.
+	Submodules (e.g. scipy.interpolate, from LazyModule('scipy'))
+	are lazily imported too.
+	'''
+	def __init__(self, name):
+		self.__dict__['_name'] = name
+		self.__dict__['_module'] = None
+
+	def _load(self):
+		if self._module is None:
+			self.__dict__['_module'] = importlib.import_module(self._name)
+		return self._module
+
+	def __getattr__(self, attribute):
+		module = self._load()
+		name = '{0}.{1}'.format(self._name, attribute)
+		try:
+			value = getattr(module, attribute)
+			if not isinstance(value, types.ModuleType):
+				return value
+			name = value.__name__
+		except AttributeError:
+			# it might be a submodule that hasn't been imported yet
+			try:
+				importlib.import_module(name)
+			except ImportError:
+				raise AttributeError("{0} has no attribute '{1}'".format(self._name, attribute))
+
+		# keep submodules lazy too, so their own submodules work
+		submodule = LazyModule(name)
+		self.__dict__[attribute] = submodule
+		return submodule
+
+	def __repr__(self):
+		return '<lazy module {0}>'.format(self._name)
+
+def timeimport(module='zachopy.oned'):
+	'''Time how long it takes a fresh Python to import a module,
+		and report which heavy packages came along with it.'''
+	heavy = ['matplotlib.pyplot', 'scipy.interpolate', 'scipy.stats', 'astropy.modeling', 'astropy.io.fits', 'pyds9']
+	code = '; '.join(['import time, sys',
+					'before = time.time()',
+					'import {0}'.format(module),
+					'print(time.time() - before)',
+					'print(\' \'.join([m for m in {0} if m in sys.modules]))'.format(heavy)])
+	output = subprocess.check_output([sys.executable, '-c', code]).decode().split('\n')
+	print('importing {0} took {1:.3f}s'.format(module, float(output[0])))
+	print('  (and loaded: {0})'.format(output[1] or 'none of {0}'.format(heavy)))
+	return float(output[0])
+
+class LRU(object):
+	'''
+	A cache that remembers the (up to) size most recently used items,
+	forgetting the least recently used ones first.
+
+	cache = LRU(32)
+	value = cache.fetch(key, calculate)	# only calls calculate() for new keys
+	cache.size = 64						# (can be changed at any time)
+	'''
+
+	def __init__(self, size=32):
+		self.size = size
+		self._items = OrderedDict()
+
+	def __len__(self):
+		return len(self._items)
+
+	def __contains__(self, key):
+		return key in self._items
+
+	def __getitem__(self, key):
+		# move the item to the (most recently used) end
+		value = self._items.pop(key)
+		self._items[key] = value
+		return value
+
+	def __setitem__(self, key, value):
+		self._items.pop(key, None)
+		self._items[key] = value
+		while len(self._items) > self.size:
+			self._items.popitem(last=False)
+
+	def fetch(self, key, calculate):
+		'''Return the item for key, calling calculate() to make it if needed.'''
+		try:
+			return self[key]
+		except KeyError:
+			value = calculate()
+			self[key] = value
+			return value
+
+	def clear(self):
+		self._items.clear()
+
 def mkdir(path):
 	'''A mkdir that doesn't complain if it fails.'''
 	try:
@@ -11,7 +113,7 @@ def mkdir(path):
 	except:
 		pass
 
-# stolen from the internet (SciPy cookbook)
+# stolen from the internet (SciPy cookbook), now using zachopy.rebin
 def rebin(a, *args):
     '''rebin ndarray data into a smaller ndarray of the same rank whose dimensions
     are factors of the original dimensions. eg. An array with 6 columns and 4 rows
@@ -20,17 +122,10 @@ def rebin(a, *args):
     >>> a=rand(6,4); b=rebin(a,3,2)
     >>> a=rand(6); b=rebin(a,2)
     '''
-    shape = a.shape
-    lenShape = len(shape)
-    factor = np.asarray(shape)/np.asarray(args)
-    evList = ['a.reshape('] + \
-             ['args[%d],factor[%d],'%(i,i) for i in range(lenShape)] + \
-             [')'] + ['.sum(%d)'%(i+1) for i in range(lenShape)] + \
-             ['/factor[%d]'%i for i in range(lenShape)]
-    #print ''.join(evList)
-    return eval(''.join(evList))
-
-# stolen from the internet (SciPy cookbook)
+    from .rebin import block
+    return block(a, args, how='mean')
+
+# stolen from the internet (SciPy cookbook), now using zachopy.rebin
 def rebin_total(a, *args):
     '''rebin ndarray data into a smaller ndarray of the same rank whose dimensions
     are factors of the original dimensions. eg. An array with 6 columns and 4 rows
@@ -39,14 +134,8 @@ def rebin_total(a, *args):
     >>> a=rand(6,4); b=rebin(a,3,2)
     >>> a=rand(6); b=rebin(a,2)
     '''
-    shape = a.shape
-    lenShape = len(shape)
-    factor = np.asarray(shape)/np.asarray(args)
-    evList = ['a.reshape('] + \
-             ['args[%d],factor[%d],'%(i,i) for i in range(lenShape)] + \
-             [')'] + ['.sum(%d)'%(i+1) for i in range(lenShape)]
-    #print ''.join(evList)
-    return eval(''.join(evList))
+    from .rebin import block
+    return block(a, args, how='sum')
 
 #swiped from stack overflow
 def find_nearest(array,value,verbose=False):
@@ -84,6 +173,74 @@ def find_two_nearest(array,value,verbose=False):
 		print
 	return nearest
 
+class SortedIndex(object):
+	'''
+	Sort an array once, so that lots of (vectorized) nearest neighbor
+	queries can be answered with binary searches (O(log N) each),
+	rather than scanning the whole array for every value.
+
+	i = SortedIndex(grid)
+	i.nearest(values)		# like find_nearest, for an array of values
+	i.bracket(values)		# like find_two_nearest, for an array of values
+	i.weights(values)		# like interpolation_weights, for the brackets
+	'''
+
+	def __init__(self, array):
+		self.array = np.asarray(array)
+		self.order = np.argsort(self.array, kind='mergesort')
+		self.sorted = self.array[self.order]
+
+	def __len__(self):
+		return len(self.sorted)
+
+	def nearest(self, values, index=False):
+		'''Return the elements closest to each of values (or their indices, if index=True).'''
+		values = np.asarray(values)
+		right = np.clip(np.searchsorted(self.sorted, values), 1, len(self) - 1)
+		left = right - 1
+		if len(self) == 1:
+			left = right = np.zeros_like(right)
+		closest = np.where(np.abs(values - self.sorted[left]) <= np.abs(self.sorted[right] - values), left, right)
+		if index:
+			return self.order[closest]
+		return self.sorted[closest]
+
+	def bracket(self, values, index=False):
+		'''
+		Return the elements on either side of each of values (or their
+		indices, if index=True), as two arrays (left, right). Values beyond
+		the ends get the end element for both, like find_two_nearest.
+		'''
+		values = np.asarray(values)
+		n = len(self)
+		left = np.clip(np.searchsorted(self.sorted, values, side='left') - 1, 0, np.maximum(n - 2, 0))
+		right = np.minimum(left + 1, n - 1)
+
+		# outside the range, both are the nearest end
+		below, above = values < self.sorted[0], values > self.sorted[-1]
+		left, right = np.where(below, 0, left), np.where(below, 0, right)
+		left, right = np.where(above, n - 1, left), np.where(above, n - 1, right)
+
+		if index:
+			return self.order[left], self.order[right]
+		return self.sorted[left], self.sorted[right]
+
+	def weights(self, values):
+		'''
+		Return the bracketing elements of each of values, and the weights
+		to give each of them to linearly interpolate, as four arrays
+		(left, right, leftweight, rightweight). Where the brackets are
+		the same (e.g. beyond the ends), the weights are (1, 0).
+		'''
+		values = np.asarray(values)
+		left, right = self.bracket(values)
+		span = (right - left).astype(float)
+		same = span == 0
+		with np.errstate(divide='ignore', invalid='ignore'):
+			leftweight = np.where(same, 1.0, (right - values)/span)
+			rightweight = np.where(same, 0.0, (values - left)/span)
+		return left, right, leftweight, rightweight
+
 def interpolation_weights(bounds, value, verbose=True):
 
 	if bounds[0] == bounds[1]:
@@ -95,6 +252,109 @@ def interpolation_weights(bounds, value, verbose=True):
 
 
 
+class GridInterpolator(object):
+	'''
+	Linearly interpolate within an N-dimensional grid of models
+	(for example, stellar spectra as a function of Teff, logg, [Fe/H]),
+	for whole arrays of query points at once.
+
+	g = GridInterpolator([teffs, loggs, metallicities], load)
+	spectra = g(points)		# points is (npoints, 3), spectra is (npoints, ...)
+
+	axes = a list of the (increasing) grid node values along each dimension
+
+	values = either a function that loads the model at one grid node,
+			as load(teff, logg, metallicity), or an array of shape
+			(len(teffs), len(loggs), len(metallicities), ...)
+	outside = what to do with points beyond the edges of the grid:
+			'clip' (use the edge), 'extrapolate' (linearly), or 'raise'
+	cachesize = how many grid nodes to keep loaded (the least recently
+			used are forgotten first)
+	'''
+
+	def __init__(self, axes, values, outside='clip', cachesize=100):
+		self.axes = [np.asarray(a) for a in axes]
+		for a in self.axes:
+			assert((np.diff(a) > 0).all())
+		self.indices = [SortedIndex(a) for a in self.axes]
+		self.values = values
+		self.outside = outside
+		self._nodes = LRU(cachesize)
+
+	@property
+	def ndim(self):
+		return len(self.axes)
+
+	def node(self, index):
+		'''Return the model at one grid node (given as a tuple of indices).'''
+		index = tuple(index)
+		def load():
+			if callable(self.values):
+				return np.asarray(self.values(*[a[i] for a, i in zip(self.axes, index)]))
+			return np.asarray(self.values[index])
+		return self._nodes.fetch(index, load)
+
+	def weights(self, points):
+		'''
+		For an (npoints, ndim) array of points, figure out the grid nodes
+		at the corners of the cell containing each point, and how much
+		weight each corner gets. Returns (corners, weights), with shapes
+		(npoints, 2**ndim, ndim) and (npoints, 2**ndim).
+		'''
+		points = np.atleast_2d(points).astype(float)
+		assert(points.shape[1] == self.ndim)
+
+		lefts, rights, leftweights, rightweights = [], [], [], []
+		for d in range(self.ndim):
+			axis, v = self.axes[d], points[:,d]
+			outside = (v < axis[0]) | (v > axis[-1])
+			if self.outside == 'raise':
+				if outside.any():
+					raise ValueError('{0} are outside the grid ({1} to {2})'.format(v[outside], axis[0], axis[-1]))
+			elif self.outside == 'clip':
+				v = np.clip(v, axis[0], axis[-1])
+
+			# find the bracketing nodes
+			left, right = self.indices[d].bracket(v, index=True)
+			if (self.outside == 'extrapolate') and (len(axis) > 1):
+				left = np.where(v < axis[0], 0, np.where(v > axis[-1], len(axis) - 2, left))
+				right = np.where(v < axis[0], 1, np.where(v > axis[-1], len(axis) - 1, right))
+
+			# and the weights, like interpolation_weights
+			span = axis[right] - axis[left]
+			same = span == 0
+			with np.errstate(divide='ignore', invalid='ignore'):
+				lefts.append(left)
+				rights.append(right)
+				leftweights.append(np.where(same, 1.0, (axis[right] - v)/span))
+				rightweights.append(np.where(same, 0.0, (v - axis[left])/span))
+
+		# combine into every corner of each cell
+		ncorners = 2**self.ndim
+		corners = np.zeros((len(points), ncorners, self.ndim), dtype=int)
+		weights = np.ones((len(points), ncorners))
+		for c in range(ncorners):
+			for d in range(self.ndim):
+				if (c >> d) & 1:
+					corners[:,c,d], w = rights[d], rightweights[d]
+				else:
+					corners[:,c,d], w = lefts[d], leftweights[d]
+				weights[:,c] *= w
+		return corners, weights
+
+	def __call__(self, points):
+		'''Interpolate the grid at an (npoints, ndim) array of points.'''
+		corners, weights = self.weights(points)
+
+		# load each of the grid nodes that's needed (only once)
+		unique, inverse = np.unique(corners.reshape(-1, self.ndim), axis=0, return_inverse=True)
+		models = np.array([self.node(u) for u in unique])
+		inverse = inverse.reshape(weights.shape)
+
+		# add up the weighted corners
+		shape = weights.shape + (1,)*(models.ndim - 1)
+		return np.sum(weights.reshape(shape)*models[inverse], axis=1)
+
 def truncate(str, n=12, etc=' ...'):
 	'''If a string is too long, truncate it with an "etc..."'''
 	if len(str) > n: